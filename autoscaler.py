@@ -1,8 +1,11 @@
+import json
 import logging
 import math
 import os
+import threading
 import time
 
+import requests
 from kubernetes import config, client
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,19 +18,34 @@ LATENCY_THRESHOLD_S = 0.33
 MIN_REPLICAS = 1
 MAX_REPLICAS = 8
 POLL_INTERVAL_S = 10
+# Stats are pushed by the monitor's server-sent event stream; a "breach" event
+# starts a scaling cycle right away instead of at the next poll. If nothing
+# arrived for STREAM_STALE_S, the autoscaler falls back to polling MONITOR_URL.
+STREAM_STATS = os.getenv("STREAM_STATS", "1") == "1"
+MONITOR_STREAM_URL = os.getenv("MONITOR_STREAM_URL", "http://monitor:9000/stream")
+STREAM_STALE_S = 3
+STREAM_RECONNECT_S = 2
+# Both the stream and the polling fallback report p99 over this monitor window,
+# which drives scale-ups.
+STATS_WINDOW = os.getenv("STATS_WINDOW", "10s")
+# Scaling down additionally requires p99 over this longer window to be within
+# the threshold, so a few quiet seconds right after a spike do not remove pods.
+SCALE_DOWN_WINDOW = os.getenv("SCALE_DOWN_WINDOW", "1m")
 SCALE_UP_FACTOR = 1.2
 SCALE_DOWN_STEP = 1
+# Minimum time between two scale-ups, so that a breach is not answered again
+# before the pods added for the previous one are ready.
+SCALE_UP_COOLDOWN_S = float(os.getenv("SCALE_UP_COOLDOWN_S", "30"))
 
-def get_p99_latency() -> float | None:
+def get_p99_latency(window: str = STATS_WINDOW) -> float | None:
     """
-    Fetches the 99th percentile latency from the monitor service.
+    Fetches the 99th percentile latency over `window` from the monitor service.
 
     Returns:
         The p99 latency in seconds, or None if fetching fails.
     """
     try:
-        import requests
-        response = requests.get(MONITOR_URL, timeout=10)
+        response = requests.get(MONITOR_URL, params={"window": window}, timeout=10)
         response.raise_for_status()
         stats = response.json()
         print(stats, response.status_code, stats.get("p99_latency"))
@@ -36,6 +54,51 @@ def get_p99_latency() -> float | None:
         logging.error(f"Could not fetch latency from monitor: {e}")
         return None
 
+class StatsStream:
+    """
+    Follows the monitor's /stream in a background thread, keeping the latest
+    stats and setting `breach` when the monitor reports a threshold breach.
+    """
+
+    def __init__(self):
+        self.stats = None
+        self.received_at = 0.0
+        self.breach = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                params = {"threshold": LATENCY_THRESHOLD_S, "window": STATS_WINDOW}
+                with requests.get(MONITOR_STREAM_URL, params=params, stream=True, timeout=(5, STREAM_STALE_S)) as response:
+                    response.raise_for_status()
+                    logging.info(f"Subscribed to monitor stats at {MONITOR_STREAM_URL}")
+                    event = "message"
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("event:"):
+                            event = line[len("event:"):].strip()
+                        elif line.startswith("data:"):
+                            self.stats = json.loads(line[len("data:"):])
+                            self.received_at = time.time()
+                            if event == "breach":
+                                logging.info(f"Monitor reports a latency breach: p99={self.stats['p99_latency']:.4f}s")
+                                self.breach.set()
+                        elif not line:
+                            event = "message"
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.warning(f"Monitor stats stream interrupted: {e}")
+            time.sleep(STREAM_RECONNECT_S)
+
+    def p99_latency(self) -> float | None:
+        """The streamed p99 latency, or None if the stream has gone quiet."""
+        if self.stats is None or time.time() - self.received_at > STREAM_STALE_S:
+            return None
+        return self.stats.get("p99_latency")
+
+    def wait(self, timeout: float):
+        """Sleeps for `timeout` seconds, or until the monitor reports a breach."""
+        self.breach.wait(timeout)
+        self.breach.clear()
+
 def get_current_replicas(apps_v1_api: client.AppsV1Api) -> int:
     """
     Gets the current number of replicas for the deployment.
@@ -77,8 +140,10 @@ def main():
     """
     The main autoscaling loop.
     
-    This function continuously polls the monitor for latency metrics and makes
-    scaling decisions based on the configured thresholds.
+    This function continuously reads latency metrics from the monitor's stats
+    stream (polling it when the stream is unavailable) and makes scaling
+    decisions based on the configured thresholds. A breach reported on the
+    stream starts the next cycle immediately.
     """
     logging.info("Starting custom autoscaler...")
     
@@ -91,18 +156,25 @@ def main():
     apps_v1 = client.AppsV1Api()
     logging.info("Kubernetes client initialized.")
 
+    last_scale_up = -math.inf
+    stream = StatsStream()
+    if STREAM_STATS:
+        threading.Thread(target=stream.run, daemon=True).start()
+
     while True:
-        p99_latency = get_p99_latency()
+        p99_latency = stream.p99_latency()
+        if p99_latency is None:
+            p99_latency = get_p99_latency()
         print(p99_latency, " - Latency")
         if p99_latency is None:
             logging.warning("Skipping scaling cycle, could not retrieve latency.")
-            time.sleep(POLL_INTERVAL_S)
+            stream.wait(POLL_INTERVAL_S)
             continue
         logging.info(f"Current p99 latency is {p99_latency:.4f}s. Target is < {LATENCY_THRESHOLD_S}s.")
         current_replicas = get_current_replicas(apps_v1)
         if current_replicas == -1:
             logging.warning("Skipping scaling cycle, could not retrieve current replica count.")
-            time.sleep(POLL_INTERVAL_S)
+            stream.wait(POLL_INTERVAL_S)
             continue
         logging.info(f"Current replica count is {current_replicas}.")
 
@@ -110,21 +182,32 @@ def main():
         print(f"{p99_latency > LATENCY_THRESHOLD_S}, {p99_latency}, {LATENCY_THRESHOLD_S}")
         if p99_latency > LATENCY_THRESHOLD_S:
             new_replicas = math.ceil(current_replicas * SCALE_UP_FACTOR)
-            if new_replicas > current_replicas:
+            since_scale_up = time.monotonic() - last_scale_up
+            if since_scale_up < SCALE_UP_COOLDOWN_S:
+                logging.info(
+                    f"Latency threshold breached, but the last scale-up was {since_scale_up:.0f}s ago "
+                    f"(cooldown {SCALE_UP_COOLDOWN_S:.0f}s). Holding steady."
+                )
+            elif new_replicas > current_replicas:
                 logging.info(f"Latency threshold breached. Scaling up from {current_replicas} to {new_replicas} replicas.")
                 scale_deployment(apps_v1, new_replicas)
+                last_scale_up = time.monotonic()
             else:
                 logging.info("Latency threshold breached, but scale-up calculation did not yield more replicas. Holding steady.")
 
         else:
             print(f"Scale Down, Current replicas: {current_replicas}, Min replicas: {MIN_REPLICAS}")
             if current_replicas > MIN_REPLICAS:
-                new_replicas = current_replicas - SCALE_DOWN_STEP
-                logging.info(f"Latency is within threshold. Scaling down from {current_replicas} to {new_replicas} replicas.")
-                scale_deployment(apps_v1, new_replicas)
+                sustained_p99 = get_p99_latency(SCALE_DOWN_WINDOW)
+                if sustained_p99 is None or sustained_p99 > LATENCY_THRESHOLD_S:
+                    logging.info(f"p99 over {SCALE_DOWN_WINDOW} is {sustained_p99}, not scaling down yet.")
+                else:
+                    new_replicas = current_replicas - SCALE_DOWN_STEP
+                    logging.info(f"Latency is within threshold. Scaling down from {current_replicas} to {new_replicas} replicas.")
+                    scale_deployment(apps_v1, new_replicas)
             else:
                 logging.info("Latency is within threshold and at minimum replicas. Holding steady.")
-        time.sleep(POLL_INTERVAL_S)
+        stream.wait(POLL_INTERVAL_S)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,40 @@
+import argparse
+import io
+import time
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+from image_service import fast_preprocess, preprocess
+
+def time_per_image(fn, contents: bytes, iterations: int) -> float:
+    """Returns the mean wall time in milliseconds of `fn(contents)`."""
+    fn(contents)  # warm-up
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        fn(contents)
+    return (time.perf_counter() - start_time) / iterations * 1000
+
+def compose_preprocess(contents: bytes) -> torch.Tensor:
+    """The original request path: full decode followed by the torchvision Compose."""
+    return preprocess(Image.open(io.BytesIO(contents)).convert("RGB"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fused preprocessing path against the torchvision Compose.")
+    parser.add_argument("--images", default="images", help="Directory with sample images")
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    for path in sorted(Path(args.images).glob("*.jpg")):
+        contents = path.read_bytes()
+        with Image.open(io.BytesIO(contents)) as img:
+            size = img.size
+        compose_ms = time_per_image(compose_preprocess, contents, args.iterations)
+        fused_ms = time_per_image(fast_preprocess, contents, args.iterations)
+        max_diff = (compose_preprocess(contents) - fast_preprocess(contents)).abs().max().item()
+        print(
+            f"{path.name} {size[0]}x{size[1]}: compose {compose_ms:.2f} ms | fused {fused_ms:.2f} ms "
+            f"| speed-up x{compose_ms / fused_ms:.2f} | max abs diff {max_diff:.3f}"
+        )
@@ -1,12 +1,26 @@
+import asyncio
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
+import mimetypes
 import os
 import random
+import statistics
+import struct
+import tarfile
 import time
+import zipfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
 import threading
 
-import requests
+import httpx
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from kubernetes import client, config, watch
 
 # Configure logging
@@ -16,7 +30,255 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 SERVICE_NAME = "image-classifier"
 NAMESPACE = "default"
 SERVICE_PORT = 5000
-MONITOR_URL = "http://monitor:9000/record"
+MONITOR_BULK_URL = os.getenv("MONITOR_BULK_URL", "http://monitor:9000/record/bulk")
+# The EndpointSlice watch is restarted (and resumed) after this many seconds.
+WATCH_TIMEOUT_S = int(os.getenv("WATCH_TIMEOUT_S", "300"))
+
+# All outgoing HTTP goes through one shared async client. httpx keeps a separate
+# keep-alive pool per origin, i.e. per backend pod, within these limits.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "512"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "128"))
+HTTP_KEEPALIVE_EXPIRY_S = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_S", "30"))
+HTTP_POOL_TIMEOUT_S = float(os.getenv("HTTP_POOL_TIMEOUT_S", "5"))
+CONNECT_TIMEOUT_S = float(os.getenv("CONNECT_TIMEOUT_S", "1"))
+BACKEND_TIMEOUT_S = float(os.getenv("BACKEND_TIMEOUT_S", "10"))
+MONITOR_TIMEOUT_S = float(os.getenv("MONITOR_TIMEOUT_S", "1"))
+
+# Latency samples are buffered in memory and sent to the monitor in batches of
+# up to REPORT_MAX_BATCH every REPORT_INTERVAL_S by a background task. When the
+# buffer holds REPORT_BUFFER_SIZE samples, the oldest ones are dropped.
+REPORT_INTERVAL_S = float(os.getenv("REPORT_INTERVAL_S", "1"))
+REPORT_BUFFER_SIZE = int(os.getenv("REPORT_BUFFER_SIZE", "20000"))
+REPORT_MAX_BATCH = int(os.getenv("REPORT_MAX_BATCH", "5000"))
+
+# Streaming pass-through: forward the raw request body and its Content-Type to
+# the backend without parsing the multipart form. The body is never buffered,
+# so the result cache cannot be consulted in this mode.
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "0") == "1"
+
+# /batch splits its images into sub-batches of BATCH_CHUNK_SIZE, sent to the
+# pods' /predict_batch in parallel. Matching the pods' MAX_BATCH_SIZE lets each
+# sub-batch run as a single forward pass.
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "8"))
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "256"))
+# Limits on the uncompressed size of each image and of a whole batch, checked
+# before anything is extracted from an archive.
+MAX_BATCH_ITEM_BYTES = int(os.getenv("MAX_BATCH_ITEM_BYTES", str(10 * 1024 * 1024)))
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", str(128 * 1024 * 1024)))
+# Priority class of /batch requests that do not send an X-Priority header.
+BATCH_PRIORITY = os.getenv("BATCH_PRIORITY", "bulk")
+
+# Load balancing strategy: round_robin, random, least_outstanding, p2c, ewma or
+# peak_ewma.
+# It can be switched at runtime through PUT /lb/strategy/{name} to compare
+# strategies on the same workload.
+LB_STRATEGY = os.getenv("LB_STRATEGY", "p2c")
+# Weight of the newest sample in each backend's latency moving average.
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", "0.3"))
+# Decay time constant of the peak-sensitive moving average: latency spikes are
+# taken immediately, improvements are blended in over roughly this period.
+PEAK_EWMA_DECAY_S = float(os.getenv("PEAK_EWMA_DECAY_S", "10"))
+
+# Outlier ejection: every EJECTION_INTERVAL_S, pods whose latency average is
+# more than EJECTION_FACTOR times the median of the other pods are taken out of
+# rotation for EJECTION_BASE_S (doubling on repeated ejections, up to
+# EJECTION_MAX_S) and then ramped back in linearly over SLOW_START_S. At most
+# MAX_EJECTION_PERCENT of the pods are ejected at any time.
+OUTLIER_EJECTION = os.getenv("OUTLIER_EJECTION", "1") == "1"
+EJECTION_INTERVAL_S = float(os.getenv("EJECTION_INTERVAL_S", "5"))
+EJECTION_FACTOR = float(os.getenv("EJECTION_FACTOR", "3"))
+EJECTION_MIN_LATENCY_S = float(os.getenv("EJECTION_MIN_LATENCY_S", "0.1"))
+EJECTION_MIN_REQUESTS = int(os.getenv("EJECTION_MIN_REQUESTS", "5"))
+EJECTION_BASE_S = float(os.getenv("EJECTION_BASE_S", "10"))
+EJECTION_MAX_S = float(os.getenv("EJECTION_MAX_S", "120"))
+MAX_EJECTION_PERCENT = float(os.getenv("MAX_EJECTION_PERCENT", "50"))
+SLOW_START_S = float(os.getenv("SLOW_START_S", "20"))
+# A pod that cannot be reached is taken out of rotation for UNHEALTHY_BASE_S
+# (doubling on consecutive failures, up to UNHEALTHY_MAX_S) and then tried
+# again with slow start, unless the watcher updates it first.
+UNHEALTHY_BASE_S = float(os.getenv("UNHEALTHY_BASE_S", "5"))
+UNHEALTHY_MAX_S = float(os.getenv("UNHEALTHY_MAX_S", "60"))
+
+# Hedged requests: when a backend has not answered within the HEDGE_PERCENTILE
+# of recent backend latencies, the same request is sent to a second pod and the
+# first answer wins. Each request earns HEDGE_BUDGET_PERCENT / 100 of a hedge
+# token, so at most that share of requests is duplicated. Streamed uploads
+# cannot be replayed and are never hedged.
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_BUDGET_PERCENT = float(os.getenv("HEDGE_BUDGET_PERCENT", "5"))
+HEDGE_MIN_DELAY_S = float(os.getenv("HEDGE_MIN_DELAY_S", "0.02"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "50"))
+
+# Admission control: the number of concurrent backend requests is capped
+# globally and per backend by adaptive AIMD limits. A limit grows by one per
+# limit's worth of requests answered within LIMIT_LATENCY_TARGET_S and shrinks
+# by LIMIT_BACKOFF on slower answers or errors. Requests beyond the limit wait
+# in a queue, and are rejected with a 503 straight away when their expected
+# queueing delay would push them past SLO_LATENCY_S.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+SLO_LATENCY_S = float(os.getenv("SLO_LATENCY_S", "0.33"))
+LIMIT_LATENCY_TARGET_S = float(os.getenv("LIMIT_LATENCY_TARGET_S", str(SLO_LATENCY_S)))
+LIMIT_BACKOFF = float(os.getenv("LIMIT_BACKOFF", "0.9"))
+GLOBAL_LIMIT_INITIAL = int(os.getenv("GLOBAL_LIMIT_INITIAL", "32"))
+GLOBAL_LIMIT_MIN = int(os.getenv("GLOBAL_LIMIT_MIN", "4"))
+GLOBAL_LIMIT_MAX = int(os.getenv("GLOBAL_LIMIT_MAX", "512"))
+BACKEND_LIMIT_INITIAL = int(os.getenv("BACKEND_LIMIT_INITIAL", "8"))
+BACKEND_LIMIT_MIN = int(os.getenv("BACKEND_LIMIT_MIN", "1"))
+BACKEND_LIMIT_MAX = int(os.getenv("BACKEND_LIMIT_MAX", "64"))
+MAX_QUEUE_LENGTH = int(os.getenv("MAX_QUEUE_LENGTH", "256"))
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", "1"))
+
+# Priority classes and tenants, taken from the X-Priority and X-Tenant request
+# headers. PRIORITY_WEIGHTS sets each class's share of the backend capacity
+# when requests are queued (e.g. "interactive=8,bulk=1"); unknown priorities
+# are treated as DEFAULT_PRIORITY. Classes listed in PRIORITY_MAX_WAIT_S may
+# queue that long instead of being held to the latency SLO.
+PRIORITY_HEADER = "x-priority"
+TENANT_HEADER = "x-tenant"
+DEFAULT_PRIORITY = os.getenv("DEFAULT_PRIORITY", "interactive")
+DEFAULT_TENANT = "default"
+
+def parse_class_map(value: str) -> dict:
+    """Parses "name=number,name=number" into a dict of floats."""
+    entries = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, number = item.split("=", 1)
+            entries[name.strip()] = float(number)
+    return entries
+
+PRIORITY_WEIGHTS = parse_class_map(os.getenv("PRIORITY_WEIGHTS", "interactive=8,bulk=1"))
+PRIORITY_MAX_WAIT_S = parse_class_map(os.getenv("PRIORITY_MAX_WAIT_S", "bulk=10"))
+# Number of backend latencies kept per strategy for the /lb/stats percentiles.
+STRATEGY_LATENCY_WINDOW = 1000
+
+# Content-addressed cache of backend results, shared by all pods behind this
+# dispatcher. Set RESULT_CACHE_SIZE to 0 to disable it. When RESULT_CACHE_URL
+# points at a Redis-compatible server, that server is used instead so that
+# several dispatcher replicas share one cache.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "8192"))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "600"))
+RESULT_CACHE_URL = os.getenv("RESULT_CACHE_URL")
+
+
+class ResultCache(ABC):
+    """Interface of the result cache used by `dispatch`, keyed by image content hash."""
+
+    @abstractmethod
+    async def get(self, key: str) -> dict | None:
+        """Returns the cached result for `key`, or None."""
+
+    @abstractmethod
+    async def set(self, key: str, result: dict):
+        """Stores `result` under `key`."""
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LRUResultCache(ResultCache):
+    """
+    In-process LRU cache with per-entry TTL.
+
+    Only used from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        result, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    async def set(self, key: str, result: dict):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (result, time.monotonic() + self.ttl_s)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"backend": "lru", "size": len(self._entries), "max_entries": self.max_entries, "evictions": self.evictions}
+
+
+class RedisResultCache(ResultCache):
+    """
+    Result cache stored in any server speaking the Redis protocol.
+
+    Cache errors are logged and treated as misses so an unavailable cache never
+    fails a request.
+    """
+
+    def __init__(self, url: str, ttl_s: float):
+        # redis is an optional dependency, only needed when RESULT_CACHE_URL is set.
+        import redis.asyncio as redis
+        self.url = url
+        self.ttl_s = ttl_s
+        self._redis = redis.from_url(url)
+
+    async def get(self, key: str) -> dict | None:
+        try:
+            value = await self._redis.get(f"prediction:{key}")
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, result: dict):
+        try:
+            await self._redis.set(f"prediction:{key}", json.dumps(result), ex=max(1, int(self.ttl_s)))
+        except Exception as e:
+            logging.warning(f"Result cache store failed: {e}")
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "url": self.url}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+
+    The call runs in its own task, so a caller that disconnects does not
+    cancel the work other callers are waiting on.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+
+def make_result_cache() -> ResultCache:
+    if RESULT_CACHE_URL:
+        return RedisResultCache(RESULT_CACHE_URL, RESULT_CACHE_TTL_S)
+    return LRUResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_S)
+
+result_cache = make_result_cache()
+single_flight = SingleFlight()
+cache_hits = 0
+cache_misses = 0
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -25,7 +287,7 @@ async def lifespan(app: FastAPI):
     
     This context manager handles the startup and shutdown events of the application.
     On startup, it loads the Kubernetes configuration and starts a background
-    thread to watch for pod updates.
+    thread to watch the service's EndpointSlices.
     """
     logging.info("Dispatcher starting up...")
     # Load Kubernetes configuration based on the environment
@@ -33,110 +295,1251 @@ async def lifespan(app: FastAPI):
         config.load_incluster_config()
     else:
         config.load_kube_config()
-    # Start the pod IP watcher in a background thread
-    threading.Thread(target=update_pod_ips_periodically, daemon=True).start()
+    # Start the EndpointSlice watcher in a background thread
+    threading.Thread(target=EndpointSliceWatcher().run, daemon=True).start()
     logging.info("Background thread for pod discovery started.")
+    global http_client
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_S,
+        ),
+        timeout=httpx.Timeout(BACKEND_TIMEOUT_S, connect=CONNECT_TIMEOUT_S, pool=HTTP_POOL_TIMEOUT_S),
+    )
+    background_tasks = [asyncio.create_task(reporter.run())]
+    if OUTLIER_EJECTION:
+        background_tasks.append(asyncio.create_task(run_outlier_detection()))
     yield
     # This part runs on shutdown.
     logging.info("Dispatcher shutting down...")
+    for task in background_tasks:
+        task.cancel()
+    await reporter.flush()
+    await http_client.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
-# A list to hold the IP addresses of the backend pods.
-POD_IPS = []
+# Shared connection-pooling HTTP client, created in `lifespan`.
+http_client: httpx.AsyncClient | None = None
 
-def watch_for_pod_updates():
+class AIMDLimit:
     """
-    Watches the Kubernetes API for changes to pods matching our service label.
-    
-    This function runs in a background thread and keeps the global POD_IPS list
-    up-to-date with the IP addresses of running and ready pods.
-    """
-    # Use a Kubernetes Watcher to get real-time updates on pod events.
-    w = watch.Watch()
-    # We watch for events on pods in our namespace that have the label 'app=image-classifier'.
-    for event in w.stream(
-        func=client.CoreV1Api().list_namespaced_pod,
-        namespace=NAMESPACE,
-        label_selector=f"app={SERVICE_NAME}",
-        timeout_seconds=60  # Periodically timeout to refresh the watch
-    ):
-        pod = event["object"]
-        pod_ip = pod.status.pod_ip
-        # We only care about pods that have an IP address and are in the 'Running' phase.
-        if pod_ip and pod.status.phase == "Running":
-            if event["type"] == "ADDED" or event["type"] == "MODIFIED":
-                if pod_ip not in POD_IPS:
-                    logging.info(f"Adding pod {pod.metadata.name} with IP {pod_ip} to the pool.")
-                    POD_IPS.append(pod_ip)
-            elif event["type"] == "DELETED":
-                if pod_ip in POD_IPS:
-                    logging.info(f"Removing pod {pod.metadata.name} with IP {pod_ip} from the pool.")
-                    POD_IPS.remove(pod_ip)
-
-def update_pod_ips_periodically():
-    """
-    A wrapper function to run the Kubernetes watcher in a loop.
-    
-    This ensures that if the watch connection breaks or times out, a new
-    one is established to maintain service discovery.
+    Concurrency limit adjusted by additive increase / multiplicative decrease.
+
+    Decreases are applied at most once per LIMIT_LATENCY_TARGET_S, so a burst
+    of slow answers to requests sent under the old limit only counts once.
     """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.value = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self._last_decrease = 0.0
+
+    def on_sample(self, latency: float, ok: bool):
+        if ok and latency <= LIMIT_LATENCY_TARGET_S:
+            self.value = min(self.maximum, self.value + 1.0 / self.value)
+            return
+        now = time.monotonic()
+        if now - self._last_decrease >= LIMIT_LATENCY_TARGET_S:
+            self.value = max(self.minimum, self.value * LIMIT_BACKOFF)
+            self._last_decrease = now
+
+    def __int__(self) -> int:
+        return int(self.value)
+
+
+class Endpoint:
+    """A backend pod together with its routing state."""
+
+    def __init__(self, uid: str, name: str, ip: str, ready: bool):
+        self.uid = uid
+        self.name = name
+        self.ip = ip
+        # Readiness as reported by Kubernetes.
+        self.ready = ready
+        # Cleared when the pod cannot be reached, set again when the watcher
+        # reports a change of its readiness or once `unhealthy_until` has passed.
+        self.healthy = True
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.in_flight = 0
+        self.limit = AIMDLimit(BACKEND_LIMIT_INITIAL, BACKEND_LIMIT_MIN, BACKEND_LIMIT_MAX)
+        self.requests = 0
+        self.ewma_latency = 0.0
+        self.peak_ewma = 0.0
+        self.peak_updated = time.monotonic()
+        # Requests completed since the last outlier detection pass.
+        self.window_requests = 0
+        # Outlier ejection state.
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.restored_at = None
+
+    def observe(self, latency: float):
+        now = time.monotonic()
+        if self.requests == 0:
+            self.ewma_latency = latency
+            self.peak_ewma = latency
+        else:
+            self.ewma_latency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma_latency
+            if latency > self.peak_ewma:
+                self.peak_ewma = latency
+            else:
+                decay = math.exp(-(now - self.peak_updated) / PEAK_EWMA_DECAY_S)
+                self.peak_ewma = self.peak_ewma * decay + latency * (1 - decay)
+        self.peak_updated = now
+        self.requests += 1
+        self.window_requests += 1
+
+    def reset_latency(self):
+        """Forgets the latency history, e.g. when a pod comes back from ejection."""
+        self.requests = 0
+        self.window_requests = 0
+        self.ewma_latency = 0.0
+        self.peak_ewma = 0.0
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def weight(self, now: float) -> float:
+        """Share of its normal traffic the pod should receive, ramping up after ejection."""
+        if self.is_ejected(now):
+            return 0.0
+        if self.restored_at is None:
+            return 1.0
+        progress = (now - self.restored_at) / SLOW_START_S if SLOW_START_S > 0 else 1.0
+        if progress >= 1.0:
+            self.restored_at = None
+            return 1.0
+        return max(0.05, progress)
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "name": self.name,
+            "ip": self.ip,
+            "ready": self.ready,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "limit": int(self.limit),
+            "requests": self.requests,
+            "ewma_latency": self.ewma_latency,
+            "peak_ewma": self.peak_ewma,
+            "ejected": self.is_ejected(now),
+            "ejections": self.ejections,
+            "weight": self.weight(now),
+        }
+
+
+class EndpointRegistry:
+    """
+    Registry of backend endpoints keyed by pod UID.
+
+    Writers (the discovery thread and failing requests) update the dictionary
+    under a lock and then publish new immutable tuples. Readers never lock:
+    they grab the current tuple, which stays consistent for as long as they
+    use it, so request handlers cannot observe a half-applied update.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._all = ()
+        self._routable = ()
+        # Earliest time an unhealthy endpoint is due to be re-admitted.
+        self._next_readmission = None
+
+    def _publish(self):
+        self._all = tuple(self._endpoints.values())
+        self._routable = tuple(e for e in self._all if e.ready and e.healthy)
+        unhealthy = [e.unhealthy_until for e in self._all if not e.healthy]
+        self._next_readmission = min(unhealthy) if unhealthy else None
+
+    def _readmit(self, now: float):
+        with self._lock:
+            for endpoint in self._all:
+                if not endpoint.healthy and now >= endpoint.unhealthy_until:
+                    logging.info(f"Re-admitting pod {endpoint.name} ({endpoint.ip}) after a failure.")
+                    endpoint.healthy = True
+                    endpoint.restored_at = now
+                    endpoint.reset_latency()
+            self._publish()
+
+    def snapshot(self) -> tuple:
+        """All known endpoints, ready or not."""
+        return self._all
+
+    def routable(self) -> tuple:
+        """Endpoints that are ready and not currently marked unhealthy."""
+        if self._next_readmission is not None:
+            now = time.monotonic()
+            if now >= self._next_readmission:
+                self._readmit(now)
+        return self._routable
+
+    def get(self, uid: str) -> Endpoint | None:
+        return self._endpoints.get(uid)
+
+    @staticmethod
+    def _update_readiness(endpoint: Endpoint, ready: bool):
+        """
+        Applies the pod's ready condition. Only an actual change clears an
+        unhealthy mark: watch events for other pods of the same slice must
+        not cut a back-off short.
+        """
+        if endpoint.ready != ready:
+            endpoint.ready = ready
+            endpoint.healthy = True
+            endpoint.unhealthy_until = 0.0
+
+    def upsert(self, uid: str, name: str, ip: str, ready: bool) -> Endpoint:
+        """Adds an endpoint or updates its address and readiness, keeping its routing state."""
+        with self._lock:
+            endpoint = self._endpoints.get(uid)
+            if endpoint is None or endpoint.ip != ip:
+                endpoint = Endpoint(uid, name, ip, ready)
+                self._endpoints[uid] = endpoint
+            else:
+                self._update_readiness(endpoint, ready)
+            self._publish()
+            return endpoint
+
+    def remove(self, uid: str) -> Endpoint | None:
+        with self._lock:
+            endpoint = self._endpoints.pop(uid, None)
+            if endpoint is not None:
+                self._publish()
+            return endpoint
+
+    def mark_unhealthy(self, endpoint: Endpoint):
+        """Takes an endpoint out of rotation for an exponentially growing back-off."""
+        with self._lock:
+            if self._endpoints.get(endpoint.uid) is endpoint and endpoint.healthy:
+                endpoint.failures += 1
+                duration = min(UNHEALTHY_BASE_S * 2 ** (endpoint.failures - 1), UNHEALTHY_MAX_S)
+                endpoint.healthy = False
+                endpoint.unhealthy_until = time.monotonic() + duration
+                logging.warning(f"Pod {endpoint.name} ({endpoint.ip}) is unreachable, retrying it in {duration:.0f}s.")
+                self._publish()
+
+    def sync(self, entries: dict):
+        """
+        Replaces the registry contents with `entries` (uid -> (name, ip, ready))
+        in a single update, keeping the routing state of pods that remain.
+        """
+        with self._lock:
+            endpoints = {}
+            for uid, (name, ip, ready) in entries.items():
+                endpoint = self._endpoints.get(uid)
+                if endpoint is None or endpoint.ip != ip:
+                    endpoint = Endpoint(uid, name, ip, ready)
+                else:
+                    self._update_readiness(endpoint, ready)
+                endpoints[uid] = endpoint
+            self._endpoints = endpoints
+            self._publish()
+
+# The backend pods requests are routed to.
+registry = EndpointRegistry()
+
+
+class RoundRobinStrategy:
+    """Cycles through the pods in order."""
+
+    name = "round_robin"
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, endpoints: tuple) -> Endpoint:
+        return endpoints[next(self._counter) % len(endpoints)]
+
+
+class RandomStrategy:
+    """Picks a pod uniformly at random."""
+
+    name = "random"
+
+    def choose(self, endpoints: tuple) -> Endpoint:
+        return random.choice(endpoints)
+
+
+class LeastOutstandingStrategy:
+    """Picks the pod with the fewest in-flight requests, breaking ties randomly."""
+
+    name = "least_outstanding"
+
+    def choose(self, endpoints: tuple) -> Endpoint:
+        return min(endpoints, key=lambda e: (e.in_flight, random.random()))
+
+
+class PowerOfTwoChoicesStrategy:
+    """Samples two pods at random and picks the one with fewer in-flight requests."""
+
+    name = "p2c"
+
+    def choose(self, endpoints: tuple) -> Endpoint:
+        if len(endpoints) < 2:
+            return endpoints[0]
+        first, second = random.sample(endpoints, 2)
+        if first.in_flight <= second.in_flight:
+            return first
+        return second
+
+
+class EWMAStrategy:
+    """
+    Picks a pod at random with probability inversely proportional to its
+    latency moving average times its in-flight count. Pods without any
+    measurement yet are tried first.
+    """
+
+    name = "ewma"
+
+    def choose(self, endpoints: tuple) -> Endpoint:
+        unmeasured = [e for e in endpoints if e.requests == 0]
+        if unmeasured:
+            return random.choice(unmeasured)
+        weights = [1.0 / (max(e.ewma_latency, 1e-3) * (e.in_flight + 1)) for e in endpoints]
+        return random.choices(endpoints, weights=weights)[0]
+
+
+class PeakEWMAStrategy:
+    """
+    Power of two choices on peak-EWMA cost: the peak-sensitive latency average
+    multiplied by the number of in-flight requests plus one. A pod whose
+    latency jumps is avoided at once and regains traffic as it recovers.
+    """
+
+    name = "peak_ewma"
+
+    def choose(self, endpoints: tuple) -> Endpoint:
+        if len(endpoints) < 2:
+            return endpoints[0]
+        first, second = random.sample(endpoints, 2)
+        if self.cost(first) <= self.cost(second):
+            return first
+        return second
+
+    @staticmethod
+    def cost(endpoint: Endpoint) -> float:
+        return endpoint.peak_ewma * (endpoint.in_flight + 1)
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (
+        RoundRobinStrategy, RandomStrategy, LeastOutstandingStrategy,
+        PowerOfTwoChoicesStrategy, EWMAStrategy, PeakEWMAStrategy,
+    )
+}
+
+load_balancer = STRATEGIES[LB_STRATEGY]()
+# Recent backend latencies observed under each strategy.
+STRATEGY_LATENCIES = {name: deque(maxlen=STRATEGY_LATENCY_WINDOW) for name in STRATEGIES}
+
+def eligible_endpoints(endpoints: tuple) -> tuple:
+    """
+    Filters out ejected endpoints and thins out endpoints that are still
+    ramping up after an ejection. Falls back to all given endpoints rather
+    than returning none.
+    """
+    now = time.monotonic()
+    eligible = tuple(e for e in endpoints if random.random() < e.weight(now))
+    return eligible or endpoints
+
+def detect_outliers():
+    """
+    Ejects pods whose latency average is far above the median of the other
+    pods and restores pods whose ejection has expired.
+    """
+    now = time.monotonic()
+    endpoints = registry.routable()
+    for endpoint in endpoints:
+        if endpoint.ejected_until and not endpoint.is_ejected(now):
+            logging.info(f"Restoring pod {endpoint.name} ({endpoint.ip}) to the pool (slow start over {SLOW_START_S}s).")
+            endpoint.ejected_until = 0.0
+            endpoint.restored_at = now
+            endpoint.reset_latency()
+
+    active = [e for e in endpoints if not e.is_ejected(now)]
+    measured = [e for e in active if e.window_requests >= EJECTION_MIN_REQUESTS]
+    if len(measured) >= 2:
+        max_ejected = int(len(endpoints) * MAX_EJECTION_PERCENT / 100)
+        ejected = len(endpoints) - len(active)
+        for endpoint in sorted(measured, key=lambda e: e.ewma_latency, reverse=True):
+            # Each pod is compared with the others only: including it would
+            # drag the median towards it, and with two pods no pod could ever
+            # exceed a multiple of the median.
+            median = statistics.median(e.ewma_latency for e in measured if e is not endpoint)
+            threshold = max(EJECTION_FACTOR * median, EJECTION_MIN_LATENCY_S)
+            if endpoint.ewma_latency <= threshold:
+                # A healthy pass slowly forgives earlier ejections.
+                endpoint.ejections = max(0, endpoint.ejections - 1)
+                continue
+            if ejected >= max_ejected:
+                break
+            endpoint.ejections += 1
+            duration = min(EJECTION_BASE_S * 2 ** (endpoint.ejections - 1), EJECTION_MAX_S)
+            endpoint.ejected_until = now + duration
+            endpoint.restored_at = None
+            ejected += 1
+            logging.warning(
+                f"Ejecting pod {endpoint.name} ({endpoint.ip}) for {duration:.0f}s: latency "
+                f"{endpoint.ewma_latency:.3f}s vs median of the other pods {median:.3f}s."
+            )
+    for endpoint in endpoints:
+        endpoint.window_requests = 0
+
+async def run_outlier_detection():
+    """Background task running `detect_outliers` every EJECTION_INTERVAL_S."""
     while True:
+        await asyncio.sleep(EJECTION_INTERVAL_S)
         try:
-            watch_for_pod_updates()
+            detect_outliers()
         except Exception as e:
-            logging.error(f"Error in Kubernetes watch stream: {e}. Retrying in 5 seconds...")
-            POD_IPS.clear()
-            time.sleep(5)
+            logging.error(f"Outlier detection failed: {e}")
+
+def percentile(values, q: float) -> float:
+    """Returns the q-th percentile (0-100) of `values` using the nearest-rank method."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
 
 
+class Hedger:
+    """
+    Decides when to send a hedged duplicate of a backend request and keeps
+    the hedging budget and win statistics.
+    """
+
+    # Upper bound on saved-up hedge tokens, so a quiet period cannot be
+    # followed by a burst of hedges.
+    MAX_TOKENS = 10.0
+
+    def __init__(self):
+        self.latencies = deque(maxlen=STRATEGY_LATENCY_WINDOW)
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.budget_exhausted = 0
+        self._delay = None
+        self._delay_updated = 0.0
+
+    def record(self, latency: float):
+        self.latencies.append(latency)
+
+    def delay(self) -> float | None:
+        """Returns how long to wait before hedging, or None without enough samples."""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        now = time.monotonic()
+        # Recomputing the percentile once a second is plenty.
+        if self._delay is None or now - self._delay_updated > 1.0:
+            self._delay = max(percentile(self.latencies, HEDGE_PERCENTILE), HEDGE_MIN_DELAY_S)
+            self._delay_updated = now
+        return self._delay
+
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(self.tokens + HEDGE_BUDGET_PERCENT / 100, self.MAX_TOKENS)
+
+    def try_acquire(self) -> bool:
+        if self.tokens < 1.0:
+            self.budget_exhausted += 1
+            return False
+        self.tokens -= 1.0
+        self.hedges += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": HEDGE_REQUESTS,
+            "delay_s": self._delay,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+            "wins": self.wins,
+            "win_rate": self.wins / self.hedges if self.hedges else 0.0,
+            "budget_exhausted": self.budget_exhausted,
+        }
+
+hedger = Hedger()
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed by admission control."""
+
+
+class AdmissionController:
+    """
+    Caps the number of backend requests in flight and queues the excess.
+
+    The effective capacity is the smaller of the global adaptive limit and
+    the sum of the per-backend limits of the routable endpoints. Waiting
+    requests are kept in one queue per (priority, tenant) flow and released
+    by deficit round robin, each flow earning its priority's weight per
+    round, so tenants of the same class share capacity equally and heavier
+    classes get proportionally more of it.
+
+    A queued request is rejected as soon as its expected wait (the requests
+    ahead of it in its class divided by the class's share of the throughput)
+    would exceed its budget, and again if that budget runs out while it is
+    still waiting. The budget is whatever is left of SLO_LATENCY_S after
+    service time, or the class's PRIORITY_MAX_WAIT_S. Only used from the
+    event loop, so no locking is needed.
+    """
+
+    def __init__(self):
+        self.limit = AIMDLimit(GLOBAL_LIMIT_INITIAL, GLOBAL_LIMIT_MIN, GLOBAL_LIMIT_MAX)
+        self.in_flight = 0
+        # Waiting (future, slots) pairs per (priority, tenant) flow, the round
+        # robin order of flows with waiters, and each flow's DRR deficit.
+        self.flows = {}
+        self.active_flows = deque()
+        self.deficits = {}
+        # Live waiters per priority; futures that timed out or were cancelled
+        # stay in their flow queue until the scheduler skips over them.
+        self.waiting = {}
+        # Slots those live waiters will take once admitted.
+        self.waiting_slots = {}
+        # Moving average of the time a request holds its slot.
+        self.service_time = None
+        self.class_counters = {}
+        self.timed_out = 0
+
+    def capacity(self) -> int:
+        backend_capacity = sum(int(e.limit) for e in registry.routable())
+        return max(1, min(int(self.limit), backend_capacity))
+
+    def queue_length(self) -> int:
+        return sum(self.waiting.values())
+
+    def _count(self, priority: str, counter: str):
+        counters = self.class_counters.setdefault(priority, {"admitted": 0, "queued": 0, "rejected": 0})
+        counters[counter] += 1
+
+    def _wait_budget(self, priority: str, slots: int = 1) -> float:
+        """Returns how long a newly queued request of `slots` may wait, or raises Overloaded."""
+        if self.queue_length() >= MAX_QUEUE_LENGTH:
+            raise Overloaded(f"queue full ({self.queue_length()} waiting)")
+        max_wait = PRIORITY_MAX_WAIT_S.get(priority)
+        if self.service_time is None:
+            return max_wait if max_wait is not None else SLO_LATENCY_S
+        budget = max_wait if max_wait is not None else SLO_LATENCY_S - self.service_time
+        competing = {p for p, count in self.waiting.items() if count} | {priority}
+        share = priority_weight(priority) / sum(priority_weight(p) for p in competing)
+        ahead = self.waiting_slots.get(priority, 0)
+        expected_wait = (ahead + slots) * self.service_time / (self.capacity() * share)
+        if expected_wait > budget:
+            raise Overloaded(
+                f"expected queueing delay {expected_wait:.3f}s for '{priority}' exceeds budget {max(budget, 0.0):.3f}s"
+            )
+        return budget
+
+    def _next_waiter(self):
+        """Picks the next waiter by deficit round robin over the active flows."""
+        while self.active_flows:
+            flow = self.active_flows[0]
+            queue = self.flows[flow]
+            while queue and queue[0][0].done():
+                queue.popleft()
+            if not queue:
+                self.active_flows.popleft()
+                del self.flows[flow]
+                del self.deficits[flow]
+                continue
+            slots = queue[0][1]
+            if self.deficits[flow] < slots:
+                self.deficits[flow] += priority_weight(flow[0])
+                if self.deficits[flow] < slots:
+                    self.active_flows.rotate(-1)
+                    continue
+            self.deficits[flow] -= slots
+            waiter, slots = queue.popleft()
+            if self.deficits[flow] < 1:
+                self.active_flows.rotate(-1)
+            return flow, waiter, slots
+        return None, None, 0
+
+    def _wake(self):
+        while self.in_flight < self.capacity():
+            flow, waiter, slots = self._next_waiter()
+            if waiter is None:
+                return
+            self.waiting[flow[0]] -= 1
+            self.waiting_slots[flow[0]] -= slots
+            self.in_flight += slots
+            waiter.set_result(None)
+
+    async def acquire(self, priority: str, tenant: str, slots: int = 1):
+        # A request is let in while any capacity is free, so a multi-slot
+        # request can exceed the limit by at most slots - 1.
+        if not self.queue_length() and self.in_flight < self.capacity():
+            self.in_flight += slots
+            self._count(priority, "admitted")
+            return
+        try:
+            budget = self._wait_budget(priority, slots)
+        except Overloaded:
+            self._count(priority, "rejected")
+            raise
+        flow = (priority, tenant)
+        waiter = asyncio.get_running_loop().create_future()
+        if flow not in self.flows:
+            self.flows[flow] = deque()
+            self.deficits[flow] = 0.0
+            self.active_flows.append(flow)
+        self.flows[flow].append((waiter, slots))
+        self.waiting[priority] = self.waiting.get(priority, 0) + 1
+        self.waiting_slots[priority] = self.waiting_slots.get(priority, 0) + slots
+        self._count(priority, "queued")
+        try:
+            await asyncio.wait({waiter}, timeout=budget)
+        except asyncio.CancelledError:
+            # The client went away; give back a slot we may have been handed.
+            if waiter.done() and not waiter.cancelled():
+                self.release(0.0, True, record=False, slots=slots)
+            else:
+                waiter.cancel()
+                self.waiting[priority] -= 1
+                self.waiting_slots[priority] -= slots
+            raise
+        if not waiter.done():
+            waiter.cancel()
+            self.waiting[priority] -= 1
+            self.waiting_slots[priority] -= slots
+            self.timed_out += 1
+            self._count(priority, "rejected")
+            raise Overloaded(f"no capacity within {budget:.3f}s for '{priority}'")
+        self._count(priority, "admitted")
+
+    def release(self, latency: float, ok: bool, record: bool = True, slots: int = 1):
+        self.in_flight -= slots
+        if record:
+            self.limit.on_sample(latency, ok)
+            if self.service_time is None:
+                self.service_time = latency
+            else:
+                self.service_time = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.service_time
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: str, tenant: str, slots: int = 1, record: bool = True):
+        """
+        Holds `slots` units of capacity for the duration of the block. With
+        `record` off, its latency does not feed the adaptive limit or the
+        service time estimate.
+        """
+        queued_at = time.time()
+        await self.acquire(priority, tenant, slots)
+        start_time = time.time()
+        reporter.add({"latency": start_time - queued_at, "phase": "queue", "priority": priority, "tenant": tenant})
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.release(time.time() - start_time, ok, record, slots)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": ADMISSION_CONTROL,
+            "limit": int(self.limit),
+            "capacity": self.capacity(),
+            "in_flight": self.in_flight,
+            "queue_length": self.queue_length(),
+            "active_flows": len(self.active_flows),
+            "service_time_s": self.service_time,
+            "timed_out": self.timed_out,
+            "classes": {
+                priority: {
+                    **counters,
+                    "waiting": self.waiting.get(priority, 0),
+                    "weight": priority_weight(priority),
+                    "p50_latency": percentile(CLASS_LATENCIES.get(priority, ()), 50),
+                    "p99_latency": percentile(CLASS_LATENCIES.get(priority, ()), 99),
+                }
+                for priority, counters in self.class_counters.items()
+            },
+        }
+
+def priority_weight(priority: str) -> float:
+    return PRIORITY_WEIGHTS.get(priority, 1.0)
+
+def request_class(request: Request) -> tuple:
+    """Returns the (priority, tenant) of a request from its headers."""
+    priority = request.headers.get(PRIORITY_HEADER, DEFAULT_PRIORITY)
+    if priority not in PRIORITY_WEIGHTS:
+        priority = DEFAULT_PRIORITY
+    tenant = request.headers.get(TENANT_HEADER, DEFAULT_TENANT)[:64]
+    return priority, tenant
+
+# Recent end-to-end latencies per priority class.
+CLASS_LATENCIES = {}
+
+admission = AdmissionController()
+
+@asynccontextmanager
+async def admitted(priority: str, tenant: str, slots: int = 1, record: bool = True):
+    """Admission control around a backend call, or a no-op when it is disabled."""
+    if not ADMISSION_CONTROL:
+        yield
+        return
+    async with admission.slot(priority, tenant, slots, record):
+        yield
+
+def parse_endpoint_slice(endpoint_slice: dict) -> dict:
+    """
+    Extracts the backend pods from a raw EndpointSlice object.
+
+    Returns:
+        A mapping of pod UID to (pod name, IP address, ready). A missing ready
+        condition means ready, as documented for EndpointSlices.
+    """
+    entries = {}
+    for endpoint in endpoint_slice.get("endpoints") or []:
+        addresses = endpoint.get("addresses") or []
+        if not addresses:
+            continue
+        target = endpoint.get("targetRef") or {}
+        uid = target.get("uid") or addresses[0]
+        name = target.get("name") or addresses[0]
+        ready = (endpoint.get("conditions") or {}).get("ready")
+        entries[uid] = (name, addresses[0], ready is not False)
+    return entries
+
+
+class EndpointSliceWatcher:
+    """
+    Keeps the registry in sync with the EndpointSlices of our service.
+
+    A full list is only done at startup and when the API server reports that
+    our resourceVersion is too old (410 Gone); otherwise every watch resumes
+    from the last resourceVersion seen, which bookmark events keep fresh
+    even when nothing changes. On errors the registry is left as it is, so
+    routing continues with the last known good set of pods.
+    """
+
+    def __init__(self):
+        self.api = client.DiscoveryV1Api()
+        self.resource_version = None
+        # Pod UIDs contributed by each slice, so an update can tell which pods left.
+        self.slice_members = {}
+
+    def relist(self):
+        response = self.api.list_namespaced_endpoint_slice(
+            NAMESPACE, label_selector=f"kubernetes.io/service-name={SERVICE_NAME}", _preload_content=False
+        )
+        slice_list = json.loads(response.data)
+        self.slice_members = {}
+        entries = {}
+        for endpoint_slice in slice_list.get("items") or []:
+            slice_entries = parse_endpoint_slice(endpoint_slice)
+            self.slice_members[endpoint_slice["metadata"]["name"]] = set(slice_entries)
+            entries.update(slice_entries)
+        registry.sync(entries)
+        self.resource_version = slice_list["metadata"]["resourceVersion"]
+        logging.info(
+            f"Listed {len(entries)} endpoints ({len(registry.routable())} ready) "
+            f"at resourceVersion {self.resource_version}."
+        )
+
+    def apply(self, event_type: str, endpoint_slice: dict):
+        slice_name = endpoint_slice["metadata"]["name"]
+        previous = self.slice_members.pop(slice_name, set())
+        entries = parse_endpoint_slice(endpoint_slice) if event_type != "DELETED" else {}
+        if entries:
+            self.slice_members[slice_name] = set(entries)
+        still_present = set().union(*self.slice_members.values()) if self.slice_members else set()
+        for uid, (name, ip, ready) in entries.items():
+            known = registry.get(uid)
+            if known is None or known.ready != ready:
+                logging.info(f"Pod {name} with IP {ip} is {'ready' if ready else 'not ready'}.")
+            registry.upsert(uid, name, ip, ready)
+        for uid in previous - still_present:
+            endpoint = registry.remove(uid)
+            if endpoint is not None:
+                logging.info(f"Removing pod {endpoint.name} with IP {endpoint.ip} from the pool.")
+
+    def watch(self):
+        """Streams EndpointSlice changes from the current resourceVersion until the watch times out."""
+        w = watch.Watch()
+        for event in w.stream(
+            self.api.list_namespaced_endpoint_slice,
+            NAMESPACE,
+            label_selector=f"kubernetes.io/service-name={SERVICE_NAME}",
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=WATCH_TIMEOUT_S,
+        ):
+            # The client only turns ERROR events (e.g. 410 Gone) into an
+            # ApiException when deserializing; we still parse the raw object,
+            # which is what the relist sees as well.
+            endpoint_slice = event["raw_object"]
+            if event["type"] in ("ADDED", "MODIFIED", "DELETED"):
+                self.apply(event["type"], endpoint_slice)
+            self.resource_version = endpoint_slice["metadata"]["resourceVersion"]
+
+    def run(self):
+        """Runs forever in a background thread."""
+        retry_delay = 1.0
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watch()
+                retry_delay = 1.0
+            except Exception as e:
+                if isinstance(e, client.ApiException) and e.status == 410:
+                    logging.info("EndpointSlice resourceVersion expired, relisting.")
+                    self.resource_version = None
+                    continue
+                logging.error(f"Error in EndpointSlice watch: {e}. Keeping last known endpoints, retrying in {retry_delay:.0f}s...")
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30.0)
+
+
+class NoBackendsAvailable(Exception):
+    """Raised when there is no backend pod to forward a request to."""
+
+async def post_to_pod(endpoint: Endpoint, strategy, path: str, **request_kwargs) -> dict:
+    """
+    Posts to `path` on `endpoint`, keeping its routing statistics up to date.
+
+    Only single-image `/predict` calls feed the latency statistics and
+    concurrency limits, since batch latencies are not comparable.
+
+    Raises:
+        httpx.HTTPError: If the backend cannot be reached or answers with an
+            error status.
+    """
+    backend_url = f"http://{endpoint.ip}:{SERVICE_PORT}{path}"
+    single = path == "/predict"
+    endpoint.in_flight += 1
+    start_time = time.time()
+    try:
+        print(f"Dispatching request to backend pod at {backend_url}")
+        response = await http_client.post(backend_url, **request_kwargs)
+        response.raise_for_status()
+        latency = time.time() - start_time
+        endpoint.failures = 0
+        if single:
+            endpoint.observe(latency)
+            endpoint.limit.on_sample(latency, True)
+            STRATEGY_LATENCIES[strategy.name].append(latency)
+            hedger.record(latency)
+            reporter.add({"latency": latency, "phase": "forward", "pod": endpoint.ip, "status": response.status_code})
+            if "x-inference-time" in response.headers:
+                reporter.add({"latency": float(response.headers["x-inference-time"]), "phase": "inference", "pod": endpoint.ip})
+        return response.json()
+    except httpx.HTTPError as e:
+        logging.error(f"Failed to dispatch request to {backend_url}: {e}")
+        if single:
+            endpoint.limit.on_sample(time.time() - start_time, False)
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else "error"
+            reporter.add({"latency": time.time() - start_time, "phase": "forward", "pod": endpoint.ip, "status": status})
+        # If a pod cannot be reached, take it out of rotation for a while. An
+        # error status means the pod is up and answering (e.g. shedding load
+        # or rejecting a bad upload), so it stays in rotation.
+        if not isinstance(e, httpx.HTTPStatusError):
+            registry.mark_unhealthy(endpoint)
+        raise
+    finally:
+        endpoint.in_flight -= 1
+
+async def forward_to_backend(path: str = "/predict", hedge: bool = False, **request_kwargs) -> dict:
+    """
+    Posts to `path` (`/predict` by default) on a backend pod chosen by the
+    active load balancing strategy and returns its JSON answer.
+
+    With `hedge` (and HEDGE_REQUESTS enabled), a duplicate is sent to a second
+    pod if the first has not answered within the hedging delay; the first
+    successful answer is returned and the other request is cancelled.
+
+    Args:
+        path: The backend endpoint to call.
+        hedge: Whether the request body can be sent more than once.
+        **request_kwargs: Body arguments for `httpx.AsyncClient.post`, e.g.
+            `files` for a re-encoded upload or `content` and `headers` for a
+            streamed one.
+
+    Raises:
+        NoBackendsAvailable: If no endpoint is ready.
+        httpx.HTTPError: If the backend cannot be reached or answers with an
+            error status.
+    """
+    # --- Load Balancing ---
+    # The snapshot stays consistent even if the watcher updates the registry.
+    strategy = load_balancer
+    endpoints = registry.routable()
+    if not endpoints:
+        raise NoBackendsAvailable()
+    endpoints = eligible_endpoints(endpoints)
+    if ADMISSION_CONTROL:
+        # Prefer endpoints below their own concurrency limit.
+        endpoints = tuple(e for e in endpoints if e.in_flight < int(e.limit)) or endpoints
+    endpoint = strategy.choose(endpoints)
+    if not (hedge and HEDGE_REQUESTS):
+        return await post_to_pod(endpoint, strategy, path, **request_kwargs)
+
+    hedger.on_request()
+    primary = asyncio.create_task(post_to_pod(endpoint, strategy, path, **request_kwargs))
+    tasks = {primary}
+    try:
+        delay = hedger.delay()
+        others = tuple(e for e in endpoints if e is not endpoint)
+        if delay is None or not others:
+            return await primary
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not hedger.try_acquire():
+            return await primary
+
+        hedge_endpoint = strategy.choose(others)
+        logging.info(f"Hedging request to {endpoint.ip} after {delay:.3f}s with a duplicate to {hedge_endpoint.ip}.")
+        secondary = asyncio.create_task(post_to_pod(hedge_endpoint, strategy, path, **request_kwargs))
+        tasks.add(secondary)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is secondary:
+                        hedger.wins += 1
+                    return task.result()
+        # Both attempts failed; surface the primary's error.
+        return primary.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+class LatencyReporter:
+    """
+    Buffers latency samples and ships them to the monitor in batches.
+
+    `add` only appends to a bounded in-memory buffer, so reporting costs the
+    request path nothing; `run` flushes the buffer on a fixed interval in the
+    background. Samples are dropped, and counted, when the buffer overflows
+    or a flush fails.
+    """
+
+    def __init__(self):
+        self.buffer = deque(maxlen=REPORT_BUFFER_SIZE)
+        self.sent = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def add(self, sample: dict):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(sample)
+
+    async def flush(self):
+        while self.buffer:
+            count = min(len(self.buffer), REPORT_MAX_BATCH)
+            groups = {}
+            for _ in range(count):
+                sample = self.buffer.popleft()
+                labels = tuple(sorted((name, str(value)) for name, value in sample.items() if name != "latency"))
+                groups.setdefault(labels, []).append(sample["latency"])
+            # One packed float32 body per label set; see the monitor's /record/bulk.
+            for labels, latencies in groups.items():
+                try:
+                    response = await http_client.post(
+                        MONITOR_BULK_URL,
+                        content=struct.pack(f"<{len(latencies)}f", *latencies),
+                        params=dict(labels),
+                        headers={"content-type": "application/octet-stream"},
+                        timeout=MONITOR_TIMEOUT_S,
+                    )
+                    response.raise_for_status()
+                    self.sent += len(latencies)
+                    count -= len(latencies)
+                except httpx.HTTPError as e:
+                    self.failed_flushes += 1
+                    self.dropped += count
+                    logging.warning(f"Could not report {count} latencies to monitor: {e}")
+                    return
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL_S)
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self.buffer),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+        }
+
+reporter = LatencyReporter()
+
+def report_latency(latency: float, priority: str, tenant: str, status: int = 200):
+    """Queues one end-to-end latency measurement, labelled with its class and status, for the monitor."""
+    if status == 200:
+        CLASS_LATENCIES.setdefault(priority, deque(maxlen=STRATEGY_LATENCY_WINDOW)).append(latency)
+    reporter.add({"latency": latency, "phase": "total", "priority": priority, "tenant": tenant, "status": status})
+
+async def classify_cached(request: Request, priority: str, tenant: str) -> dict:
+    """
+    Classifies an uploaded image through the result cache.
+
+    On a miss the image is forwarded to a backend; concurrent misses for the
+    same image share a single backend call.
+    """
+    global cache_hits, cache_misses
+
+    form = await request.form()
+    image = form["image"]
+    image_bytes = await image.read()
+    cache_key = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+    result = await result_cache.get(cache_key)
+    if result is not None:
+        cache_hits += 1
+        return result
+    cache_misses += 1
+    if not registry.routable():
+        raise NoBackendsAvailable()
+
+    async def classify() -> dict:
+        files = {"image": (image.filename, image_bytes, image.content_type)}
+        async with admitted(priority, tenant):
+            answer = await forward_to_backend(hedge=True, files=files)
+        await result_cache.set(cache_key, answer)
+        return answer
+
+    return await single_flight.do(cache_key, classify)
+
+async def classify_streamed(request: Request, priority: str, tenant: str) -> dict:
+    """Streams the raw request body to a backend without parsing or re-encoding it."""
+    if not registry.routable():
+        raise NoBackendsAvailable()
+    headers = {"content-type": request.headers["content-type"]}
+    if "content-length" in request.headers:
+        # Lets httpx send a plain body instead of chunked transfer encoding.
+        headers["content-length"] = request.headers["content-length"]
+    async with admitted(priority, tenant):
+        return await forward_to_backend(content=request.stream(), headers=headers)
+
 @app.post("/")
 async def dispatch(request: Request):
     """
     The main dispatch endpoint.
     
-    This function receives a request, forwards it to a randomly chosen
-    backend pod, measures the latency, and reports it to the monitor.
+    This function receives a request, answers it from the result cache when
+    the same image was classified recently, and otherwise forwards it to a
+    randomly chosen backend pod. Concurrent uploads of the same image share a
+    single backend call. With STREAM_UPLOADS the body is instead streamed to
+    the pod as-is. Requests that admission control cannot serve within the
+    latency SLO are rejected with a 503; while requests are queued, they are
+    scheduled fairly across the priority classes and tenants given by the
+    X-Priority and X-Tenant headers. The latency is measured and reported to
+    the monitor.
     """
     start_time = time.time()
-    if not POD_IPS:
-        return {"error": "No backend pods available"}, 503
+    priority, tenant = request_class(request)
 
-    # --- Round-Robin Load Balancing ---
-    # Select a random pod from our list of available IPs.
-    pod_ip = random.choice(POD_IPS)
-    backend_url = f"http://{pod_ip}:{SERVICE_PORT}/predict"
-    
     try:
-        print(f"Dispatching request to backend pod at {backend_url}")
-        # Forward the request content to the chosen backend pod.
-        form = await request.form()
-        image = form["image"]
-        image_bytes = await image.read()
-        files = {"image": (image.filename, image_bytes, image.content_type)}
+        if STREAM_UPLOADS:
+            result = await classify_streamed(request, priority, tenant)
+        else:
+            result = await classify_cached(request, priority, tenant)
+    except NoBackendsAvailable:
+        response = JSONResponse(status_code=503, content={"error": "No backend pods available"})
+    except Overloaded as e:
+        logging.warning(f"Shedding request: {e}")
+        response = JSONResponse(
+            status_code=503,
+            content={"error": "Dispatcher overloaded, retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
+    except httpx.HTTPError as e:
+        response = JSONResponse(status_code=500, content={"error": f"Failed to connect to backend service: {e}"})
+    else:
+        response = result
 
-        response = requests.post(backend_url, files=files, timeout=10)
-        response.raise_for_status()
+    # Calculate the end-to-end latency and report it to the monitor.
+    latency = time.time() - start_time
+    report_latency(latency, priority, tenant, getattr(response, "status_code", 200))
+    return response
 
-        # Calculate the end-to-end latency.
-        latency = time.time() - start_time
+class BatchTooLarge(Exception):
+    """Raised when a batch has too many images or too many bytes."""
+
+class BatchBudget:
+    """Checks the images of a batch against the item and size limits as they are read."""
 
-        # Report the latency to the monitor service in a non-blocking way.
+    def __init__(self):
+        self.items = 0
+        self.bytes = 0
+
+    def admit(self, name: str, size: int):
+        self.items += 1
+        self.bytes += size
+        if self.items > MAX_BATCH_ITEMS:
+            raise BatchTooLarge(f"Batch exceeds {MAX_BATCH_ITEMS} images")
+        if size > MAX_BATCH_ITEM_BYTES:
+            raise BatchTooLarge(f"{name} exceeds {MAX_BATCH_ITEM_BYTES} bytes")
+        if self.bytes > MAX_BATCH_BYTES:
+            raise BatchTooLarge(f"Batch exceeds {MAX_BATCH_BYTES} bytes")
+
+async def read_batch_items(request: Request) -> list:
+    """
+    Extracts the images of a batch request, in order.
+
+    Accepts a multipart form with one file field per image, or a zip or
+    (optionally compressed) tar archive as the raw request body. Archive
+    members are checked against MAX_BATCH_ITEMS, MAX_BATCH_ITEM_BYTES and
+    MAX_BATCH_BYTES from their headers before they are extracted.
+
+    Returns:
+        A list of (filename, bytes, content type) tuples.
+
+    Raises:
+        BatchTooLarge: If a limit is exceeded.
+    """
+    budget = BatchBudget()
+    items = []
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form(max_files=MAX_BATCH_ITEMS + 1)
+        for _, value in form.multi_items():
+            if not isinstance(value, str):
+                budget.admit(value.filename, value.size or 0)
+                items.append((value.filename, await value.read(), value.content_type))
+        return items
+    body = await request.body()
+    if zipfile.is_zipfile(io.BytesIO(body)):
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    # Reads stop at the declared file_size, so it bounds the extraction.
+                    budget.admit(info.filename, info.file_size)
+                    items.append((info.filename, archive.read(info), None))
+    else:
+        with tarfile.open(fileobj=io.BytesIO(body), mode="r:*") as archive:
+            for member in archive:
+                if member.isfile():
+                    budget.admit(member.name, member.size)
+                    items.append((member.name, archive.extractfile(member).read(), None))
+    return [
+        (name, data, content_type or mimetypes.guess_type(name)[0] or "application/octet-stream")
+        for name, data, content_type in items
+    ]
+
+@app.post("/batch")
+async def dispatch_batch(request: Request):
+    """
+    Classifies many images in one request.
+
+    Images found in the result cache are answered directly; the rest are
+    split into sub-batches of BATCH_CHUNK_SIZE that are sent in parallel to
+    the pods' `/predict_batch`, each going through admission control and load
+    balancing like a single request. Results come back in upload order with
+    a per-image `prediction` or `error`. Without an X-Priority header the
+    batch runs in the BATCH_PRIORITY class, and at most as many of its
+    sub-batches are in flight as the current capacity can take at once.
+    """
+    priority, tenant = request_class(request)
+    if PRIORITY_HEADER not in request.headers:
+        priority = BATCH_PRIORITY
+    try:
+        items = await read_batch_items(request)
+    except BatchTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except (tarfile.TarError, zipfile.BadZipFile, KeyError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Could not read batch: {e}"})
+    if not items:
+        return JSONResponse(status_code=400, content={"error": "No images in batch"})
+
+    keys = [hashlib.blake2b(data, digest_size=16).hexdigest() for _, data, _ in items]
+    results = [None] * len(items)
+    for i, key in enumerate(keys):
+        cached = await result_cache.get(key)
+        if cached is not None:
+            results[i] = {"filename": items[i][0], **cached}
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing and not registry.routable():
+        return JSONResponse(status_code=503, content={"error": "No backend pods available"})
+
+    in_flight = asyncio.Semaphore(max(1, admission.capacity() // BATCH_CHUNK_SIZE))
+
+    async def classify_chunk(indices: list):
+        files = [("images", items[i]) for i in indices]
         try:
-            print(f"Reported latency {latency:.3f}s to monitor at {MONITOR_URL}")
-            requests.post(MONITOR_URL, json={"latency": latency}, timeout=1)
-        except requests.exceptions.RequestException as e:
-            logging.warning(f"Could not report latency to monitor: {e}")
-            
-        return response.json()
+            # A sub-batch occupies the pod like one request per image, but its
+            # latency is not comparable with single requests, so it stays out
+            # of the adaptive limit and service time.
+            async with in_flight, admitted(priority, tenant, slots=len(indices), record=False):
+                answer = await forward_to_backend(path="/predict_batch", files=files)
+        except (NoBackendsAvailable, Overloaded, httpx.HTTPError) as e:
+            for i in indices:
+                results[i] = {"filename": items[i][0], "error": f"Could not classify image: {e}"}
+            return
+        for i, entry in zip(indices, answer["predictions"]):
+            results[i] = {**entry, "filename": items[i][0]}
+            if "prediction" in entry:
+                await result_cache.set(keys[i], {"prediction": entry["prediction"]})
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to dispatch request to {backend_url}: {e}")
-        # If a pod fails, remove it from the list to avoid sending more
-        # requests to it until the watcher verifies its status again.
-        if pod_ip in POD_IPS:
-            POD_IPS.remove(pod_ip)
-        return {"error": f"Failed to connect to backend service: {e}"}, 500
+    chunks = [missing[start:start + BATCH_CHUNK_SIZE] for start in range(0, len(missing), BATCH_CHUNK_SIZE)]
+    await asyncio.gather(*(classify_chunk(chunk) for chunk in chunks))
+    return {"predictions": results}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Returns the result cache hit/miss counters and single-flight coalescing count."""
+    lookups = cache_hits + cache_misses
+    return {
+        **result_cache.stats(),
+        "hits": cache_hits,
+        "misses": cache_misses,
+        "hit_rate": cache_hits / lookups if lookups else 0.0,
+        "coalesced": single_flight.coalesced,
+    }
+
+@app.get("/reporter/stats")
+def reporter_stats():
+    """Returns the latency reporter's buffer size and sent/dropped counters."""
+    return reporter.stats()
+
+@app.get("/admission/stats")
+def admission_stats():
+    """Returns the adaptive concurrency limit, queue length and per-class admission counters and latencies."""
+    return admission.stats()
+
+@app.get("/lb/stats")
+def lb_stats():
+    """Returns the active strategy, per-pod routing state and backend latency percentiles per strategy."""
+    return {
+        "strategy": load_balancer.name,
+        "pods": {endpoint.uid: endpoint.to_dict(time.monotonic()) for endpoint in registry.snapshot()},
+        "strategies": {
+            name: {
+                "count": len(latencies),
+                "p50_latency": percentile(latencies, 50),
+                "p99_latency": percentile(latencies, 99),
+            }
+            for name, latencies in STRATEGY_LATENCIES.items()
+        },
+        "hedging": hedger.stats(),
+    }
+
+@app.put("/lb/strategy/{name}")
+def set_lb_strategy(name: str):
+    """Switches the load balancing strategy used for new requests."""
+    global load_balancer
+    if name not in STRATEGIES:
+        return JSONResponse(status_code=400, content={"error": f"Unknown strategy '{name}'", "available": list(STRATEGIES)})
+    load_balancer = STRATEGIES[name]()
+    logging.info(f"Load balancing strategy set to '{name}'.")
+    return {"strategy": name}
 
 if __name__ == '__main__':
     import uvicorn
@@ -1,34 +1,566 @@
+import asyncio
+import gc
+import hashlib
 import io
 import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
 
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Response, UploadFile
 from fastapi.responses import JSONResponse
+import numpy as np
 from PIL import Image
 import torch
 import torchvision.transforms as T
 from torchvision.models import mobilenet_v2, MobileNet_V2_Weights
+from torchvision.models.quantization import mobilenet_v2 as quantizable_mobilenet_v2, MobileNet_V2_QuantizedWeights
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = FastAPI(title="Image Classification Service")
+# Dynamic micro-batching: concurrent requests are coalesced into a single
+# forward pass of up to MAX_BATCH_SIZE images, waiting at most MAX_BATCH_WAIT_MS
+# for the batch to fill up.
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", "5"))
 
-# Load the pre-trained MobileNetV2 model.
-model = mobilenet_v2(weights=MobileNet_V2_Weights.DEFAULT)
-model.eval()
+def get_cpu_limit() -> int:
+    """
+    Returns the number of whole CPUs this container may use (at least 1).
+
+    Reads the cgroup CPU quota (v2, then v1) so that the pod's `cpu` limit is
+    respected, falling back to the host CPU count when no quota is set. A
+    fractional quota is rounded down: sizing threads to a rounded-up count
+    (2 for a 1250m limit) would oversubscribe the quota and get the pod
+    throttled by CFS.
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(quota) // int(period))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, quota // period)
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+CPU_LIMIT = get_cpu_limit()
+
+# Number of uvicorn worker processes. With more than one, the weights are
+# written once to SHARED_WEIGHTS_PATH (tmpfs) and every worker memory-maps them,
+# so the pod holds a single copy of the model regardless of the worker count.
+WORKERS = int(os.getenv("WORKERS", "1"))
+SHARED_WEIGHTS_PATH = os.getenv("SHARED_WEIGHTS_PATH", "/dev/shm/mobilenet_v2.pt")
+CPUS_PER_WORKER = max(1, CPU_LIMIT // WORKERS)
+
+# Decoding, preprocessing and the forward pass run on a dedicated thread pool so
+# they never block the event loop. Only one forward pass runs at a time (the
+# micro-batcher serialises them), so it gets all TORCH_NUM_THREADS intra-op
+# threads while the one extra pool thread decodes the next images. Decoding is
+# short next to a forward pass, so that thread only briefly exceeds the quota.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", str(CPUS_PER_WORKER + 1)))
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", str(CPUS_PER_WORKER)))
+
+# Admission control: requests beyond MAX_PENDING_REQUESTS are rejected with a
+# 503 and a Retry-After hint instead of queueing up latency.
+MAX_PENDING_REQUESTS = int(os.getenv("MAX_PENDING_REQUESTS", "64"))
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", "1"))
+
+# Execution backend for the forward pass: eager, torchscript, compile or onnx.
+# Frozen TorchScript and ONNX Runtime fold the weights into their own graphs, so
+# they do not benefit from the shared weights of a multi-worker pod.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "/tmp/mobilenet_v2.onnx")
+# Maximum absolute logit difference tolerated between a backend and eager mode.
+PARITY_TOLERANCE = float(os.getenv("PARITY_TOLERANCE", "1e-3"))
+WARMUP_ITERATIONS = int(os.getenv("WARMUP_ITERATIONS", "3"))
+
+# Optional INT8 model: "off", "torchvision" (pre-quantized torchvision weights)
+# or "static" (post-training static quantization calibrated on CALIBRATION_DIR).
+# The quantized model is built per process and is not shared between workers.
+QUANTIZATION = os.getenv("QUANTIZATION", "off")
+QUANTIZED_ENGINE = os.getenv("QUANTIZED_ENGINE", "x86")
+CALIBRATION_DIR = os.getenv("CALIBRATION_DIR", "images")
+# Held-out images on which the INT8 model's top-1 agreement with fp32 is
+# measured at startup. Without them the agreement is only an in-sample check
+# on the calibration images.
+EVALUATION_DIR = os.getenv("EVALUATION_DIR", "")
+MIN_EVALUATION_IMAGES = 50
+
+# Repeat uploads of identical bytes are answered from an in-memory LRU cache.
+# Set PREDICTION_CACHE_SIZE to 0 to disable it.
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "4096"))
+PREDICTION_CACHE_TTL_S = float(os.getenv("PREDICTION_CACHE_TTL_S", "600"))
+
+torch.set_num_threads(TORCH_NUM_THREADS)
+executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+def load_model() -> torch.nn.Module:
+    """
+    Loads the pre-trained MobileNetV2 model.
+
+    Worker processes started by a multi-worker parent map the weights exported
+    to SHARED_WEIGHTS_PATH instead of holding their own copy. The module is
+    built on the meta device so no throw-away parameters are allocated.
+    """
+    if os.getenv("USE_SHARED_WEIGHTS") == "1" and os.path.exists(SHARED_WEIGHTS_PATH):
+        state_dict = torch.load(SHARED_WEIGHTS_PATH, mmap=True, weights_only=True)
+        with torch.device("meta"):
+            shared_model = mobilenet_v2()
+        shared_model.load_state_dict(state_dict, assign=True)
+        logging.info(f"Loaded shared model weights from {SHARED_WEIGHTS_PATH} (pid {os.getpid()}).")
+        return shared_model.eval()
+    return mobilenet_v2(weights=MobileNet_V2_Weights.DEFAULT).eval()
+
+def export_shared_weights(path: str):
+    """Writes the model weights to `path` for worker processes to memory-map."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+    logging.info(f"Exported model weights to {path} for {WORKERS} workers.")
+
+model = load_model()
 
 LABELS = MobileNet_V2_Weights.DEFAULT.meta["categories"]
 
+RESIZE_SIZE = 256
+CROP_SIZE = 224
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# Reference torchvision pipeline. Requests go through the fused path below,
+# this one is kept for benchmarking and comparison (see benchmark_preprocess.py).
 preprocess = T.Compose([
-    T.Resize(256),
-    T.CenterCrop(224),
+    T.Resize(RESIZE_SIZE),
+    T.CenterCrop(CROP_SIZE),
     T.ToTensor(),
-    T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    T.Normalize(mean=MEAN, std=STD),
 ])
 
+# Normalisation folded into one multiply-add on uint8 pixels:
+# (x / 255 - mean) / std == x * (1 / (255 * std)) + (-mean / std)
+NORM_SCALE = (1.0 / (255.0 * torch.tensor(STD))).view(1, 3, 1, 1)
+NORM_BIAS = (-torch.tensor(MEAN) / torch.tensor(STD)).view(1, 3, 1, 1)
+
+def decode_image(contents: bytes) -> Image.Image:
+    """
+    Decodes an uploaded image straight to its 224x224 RGB center crop.
+
+    For JPEGs, `draft()` lets libjpeg scale the DCT so the image is decoded at
+    the smallest power-of-two reduction whose shorter side is still at least
+    RESIZE_SIZE. The resize to RESIZE_SIZE and the center crop are then done
+    as a single resampling of the matching source box.
+    """
+    img = Image.open(io.BytesIO(contents))
+    img.draft("RGB", (RESIZE_SIZE, RESIZE_SIZE))
+    img = img.convert("RGB")
+    width, height = img.size
+    # Same geometry as T.Resize(RESIZE_SIZE) followed by T.CenterCrop(CROP_SIZE).
+    scale = RESIZE_SIZE / min(width, height)
+    resized_width = RESIZE_SIZE if width <= height else int(RESIZE_SIZE * width / height)
+    resized_height = RESIZE_SIZE if height <= width else int(RESIZE_SIZE * height / width)
+    left = int(round((resized_width - CROP_SIZE) / 2.0))
+    top = int(round((resized_height - CROP_SIZE) / 2.0))
+    box = (left / scale, top / scale, (left + CROP_SIZE) / scale, (top + CROP_SIZE) / scale)
+    return img.resize((CROP_SIZE, CROP_SIZE), Image.BILINEAR, box=box)
+
+def normalize_batch(pixels: torch.Tensor, out: torch.Tensor) -> torch.Tensor:
+    """
+    Converts a uint8 NHWC batch into the normalised float NCHW model input.
+
+    Args:
+        pixels: uint8 tensor of shape (N, 224, 224, 3).
+        out: float32 tensor of shape (N, 3, 224, 224) that receives the result.
+
+    Returns:
+        `out`.
+    """
+    return torch.addcmul(NORM_BIAS, pixels.permute(0, 3, 1, 2), NORM_SCALE, out=out)
+
+def fast_preprocess(contents: bytes) -> torch.Tensor:
+    """Returns the normalised (3, 224, 224) input tensor for a single image."""
+    pixels = torch.from_numpy(np.array(decode_image(contents))).unsqueeze(0)
+    return normalize_batch(pixels, torch.empty(1, 3, CROP_SIZE, CROP_SIZE))[0]
+
+
+def load_calibration_set(directory: str, flip: bool = True) -> list:
+    """
+    Loads every image in `directory` as a preprocessed tensor.
+
+    With `flip`, each image is also added horizontally flipped to give the
+    observers a slightly wider range of activations from a small sample
+    directory.
+    """
+    samples = []
+    for path in sorted(Path(directory).glob("*")):
+        if path.suffix.lower() not in (".jpg", ".jpeg", ".png"):
+            continue
+        img_t = fast_preprocess(path.read_bytes())
+        samples.append(img_t)
+        if flip:
+            samples.append(torch.flip(img_t, dims=[2]))
+    return samples
+
+def quantize_model(mode: str, fp32_model: torch.nn.Module, calibration_set: list) -> torch.nn.Module:
+    """
+    Builds an INT8 MobileNetV2.
+
+    Args:
+        mode: "torchvision" or "static".
+        fp32_model: The floating point model whose weights are quantized in
+            "static" mode.
+        calibration_set: Preprocessed tensors used to calibrate the observers.
+
+    Returns:
+        The quantized model in eval mode.
+    """
+    if mode == "torchvision":
+        weights = MobileNet_V2_QuantizedWeights.DEFAULT
+        torch.backends.quantized.engine = weights.meta["backend"]
+        return quantizable_mobilenet_v2(weights=weights, quantize=True).eval()
+    if mode == "static":
+        if not calibration_set:
+            raise ValueError(f"No calibration images found in {CALIBRATION_DIR}")
+        engine = QUANTIZED_ENGINE
+        if engine not in torch.backends.quantized.supported_engines:
+            engine = "qnnpack"
+        torch.backends.quantized.engine = engine
+        qmodel = quantizable_mobilenet_v2(weights=None, quantize=False)
+        qmodel.load_state_dict(fp32_model.state_dict())
+        qmodel.eval()
+        qmodel.fuse_model(is_qat=False)
+        qmodel.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+        torch.ao.quantization.prepare(qmodel, inplace=True)
+        with torch.no_grad():
+            for start in range(0, len(calibration_set), MAX_BATCH_SIZE):
+                qmodel(torch.stack(calibration_set[start:start + MAX_BATCH_SIZE]))
+        return torch.ao.quantization.convert(qmodel, inplace=True)
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+def top1_agreement(fp32_model: torch.nn.Module, int8_model: torch.nn.Module, samples: list) -> float:
+    """Returns the fraction of `samples` on which both models agree on the top-1 class."""
+    if not samples:
+        return float("nan")
+    batch_t = torch.stack(samples)
+    with torch.no_grad():
+        expected = fp32_model(batch_t).argmax(1)
+        actual = int8_model(batch_t).argmax(1)
+    return (expected == actual).float().mean().item()
+
+def load_serving_model(fp32_model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Returns the model that should serve requests according to QUANTIZATION.
+
+    The top-1 agreement between the quantized and fp32 models is logged,
+    measured on the held-out EVALUATION_DIR images when given and otherwise
+    (with a warning) on the calibration images; any failure falls back to
+    fp32.
+    """
+    if QUANTIZATION == "off":
+        return fp32_model
+    try:
+        calibration_set = load_calibration_set(CALIBRATION_DIR)
+        int8_model = quantize_model(QUANTIZATION, fp32_model, calibration_set)
+    except Exception as e:
+        logging.error(f"Could not build '{QUANTIZATION}' quantized model: {e}. Serving fp32 model.")
+        return fp32_model
+    evaluation_set = load_calibration_set(EVALUATION_DIR, flip=False) if EVALUATION_DIR else []
+    if evaluation_set:
+        sample = "held-out images"
+    else:
+        evaluation_set = calibration_set
+        sample = "calibration tensors (in-sample)"
+        logging.warning(
+            "No EVALUATION_DIR images: top-1 agreement is measured on the calibration images "
+            "themselves and says little about INT8 accuracy."
+        )
+    if len(evaluation_set) < MIN_EVALUATION_IMAGES:
+        logging.warning(
+            f"Top-1 agreement is based on only {len(evaluation_set)} samples; "
+            f"use at least {MIN_EVALUATION_IMAGES} held-out images for a meaningful estimate."
+        )
+    agreement = top1_agreement(fp32_model, int8_model, evaluation_set)
+    logging.info(
+        f"Serving INT8 model ({QUANTIZATION}, engine {torch.backends.quantized.engine}): "
+        f"top-1 agreement with fp32 {agreement:.1%} over {len(evaluation_set)} {sample}."
+    )
+    return int8_model
+
+def build_backend(name: str, eager_model: torch.nn.Module):
+    """
+    Wraps the eager model in the requested inference backend.
+
+    Args:
+        name: One of "eager", "torchscript", "compile" or "onnx".
+        eager_model: The loaded MobileNetV2 in eval mode.
+
+    Returns:
+        A callable mapping a float batch of shape (N, 3, 224, 224) to logits.
+    """
+    if name == "eager":
+        return eager_model
+    if name == "torchscript":
+        with torch.no_grad():
+            scripted = torch.jit.script(eager_model)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+    if name == "compile":
+        return torch.compile(eager_model, dynamic=True)
+    if name == "onnx":
+        # ONNX Runtime is optional and only needed for this backend.
+        import onnxruntime as ort
+
+        example = torch.randn(1, 3, 224, 224)
+        torch.onnx.export(
+            eager_model, example, ONNX_MODEL_PATH,
+            input_names=["input"], output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        )
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = TORCH_NUM_THREADS
+        session = ort.InferenceSession(ONNX_MODEL_PATH, options, providers=["CPUExecutionProvider"])
+
+        def run_onnx(batch_t: torch.Tensor) -> torch.Tensor:
+            return torch.from_numpy(session.run(None, {"input": batch_t.numpy()})[0])
+
+        return run_onnx
+    raise ValueError(f"Unknown inference backend: {name}")
+
+def check_backend(backend, eager_model: torch.nn.Module) -> float:
+    """
+    Warms up `backend` and compares its output against eager mode.
+
+    Both the single-image and the full-batch shapes are exercised, since those
+    are the shapes the micro-batcher produces most often.
+
+    Returns:
+        The largest absolute logit difference seen.
+    """
+    max_diff = 0.0
+    for batch_size in sorted({1, MAX_BATCH_SIZE}):
+        batch_t = torch.randn(batch_size, 3, 224, 224)
+        with torch.no_grad():
+            expected = eager_model(batch_t)
+            for _ in range(WARMUP_ITERATIONS):
+                actual = backend(batch_t)
+            start_time = time.perf_counter()
+            actual = backend(batch_t)
+            elapsed = time.perf_counter() - start_time
+        if not torch.equal(expected.argmax(1), actual.argmax(1)):
+            max_diff = float("inf")
+        max_diff = max(max_diff, (expected - actual).abs().max().item())
+        logging.info(f"Backend warm-up: batch {batch_size} took {elapsed * 1000:.1f} ms.")
+    return max_diff
+
+def load_backend(name: str, eager_model: torch.nn.Module):
+    """
+    Builds, warms up and validates the configured backend.
+
+    Falls back to eager mode if the backend cannot be built (e.g. a missing
+    optional dependency) or its output drifts beyond PARITY_TOLERANCE.
+    """
+    try:
+        backend = build_backend(name, eager_model)
+        max_diff = check_backend(backend, eager_model)
+    except Exception as e:
+        logging.error(f"Could not initialise '{name}' backend: {e}. Falling back to eager mode.")
+        return eager_model
+    if max_diff > PARITY_TOLERANCE:
+        logging.error(f"'{name}' backend deviates from eager mode by {max_diff:.2e}. Falling back to eager mode.")
+        return eager_model
+    logging.info(f"Using '{name}' inference backend (max deviation from eager {max_diff:.2e}).")
+    return backend
+
+
+class MicroBatcher:
+    """
+    Gathers preprocessed images from concurrent requests and runs them through
+    the model as one batch.
+
+    Each caller awaits a future that is resolved with the top-1 class index of
+    its own image once the batch containing it has been classified. Pixels are
+    copied into a preallocated uint8 buffer and normalised into a reusable float
+    buffer; this is safe because only one batch is in flight at a time.
+    """
+
+    def __init__(self, model, executor, max_batch_size: int, max_wait_s: float):
+        self.model = model
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self._pixels = torch.empty((max_batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=torch.uint8)
+        self._pixels_np = self._pixels.numpy()
+        self._inputs = torch.empty((max_batch_size, 3, CROP_SIZE, CROP_SIZE), dtype=torch.float32)
+        self.queue = None
+        self._task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, img: Image.Image) -> int:
+        """Queues a single decoded 224x224 RGB crop and waits for its class index."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, future))
+        return await future
+
+    async def _collect(self) -> list:
+        """Blocks for the first item, then fills the batch until it is full or the wait expires."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already queued without yielding to the event loop.
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _forward(self, images) -> list:
+        count = len(images)
+        for i, img in enumerate(images):
+            self._pixels_np[i] = np.asarray(img)
+        batch_t = normalize_batch(self._pixels[:count], self._inputs[:count])
+        with torch.no_grad():
+            out = self.model(batch_t)
+        return out.argmax(1).tolist()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            images, futures = zip(*batch)
+            try:
+                indices = await loop.run_in_executor(self.executor, self._forward, images)
+            except Exception as e:
+                logging.error(f"Batch inference failed for {len(batch)} images: {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, index in zip(futures, indices):
+                # The caller may have gone away (client disconnect) while we were busy.
+                if not future.done():
+                    future.set_result(index)
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of predictions keyed by a BLAKE2b digest of the image bytes.
+
+    Entries expire after `ttl_s` seconds. All access happens on the event loop,
+    so no locking is needed.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(contents: bytes) -> str:
+        return hashlib.blake2b(contents, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        prediction, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return prediction
+
+    def put(self, key: str, prediction: str):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (prediction, time.monotonic() + self.ttl_s)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL_S)
+batcher = MicroBatcher(model, executor, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS / 1000)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Application lifespan manager.
+
+    Prepares the inference backend and starts the micro-batching loop on
+    startup, and stops it on shutdown.
+    """
+    batcher.model = load_backend(INFERENCE_BACKEND, load_serving_model(model))
+    await batcher.start()
+    logging.info(f"Micro-batcher started (max batch {MAX_BATCH_SIZE}, max wait {MAX_BATCH_WAIT_MS} ms).")
+    yield
+    await batcher.stop()
+    executor.shutdown(wait=False)
+
+app = FastAPI(title="Image Classification Service", lifespan=lifespan)
+
+# Number of requests currently admitted and not yet answered. Only touched from
+# the event loop, so no locking is needed.
+pending_requests = 0
+
 @app.post("/predict")
-async def predict(image: UploadFile = File(...)):
+async def predict(response: Response, image: UploadFile = File(...)):
     """
     Receives an image, preprocesses it, and returns the top-1 prediction.
+
+    Images whose bytes were seen recently are answered from the prediction
+    cache. Otherwise the forward pass is shared with any other requests that
+    arrive within the micro-batching window, and the time spent decoding and
+    classifying is returned in the X-Inference-Time header (seconds). When
+    too many requests are already pending, a 503 with a Retry-After header
+    is returned immediately.
     
     Args:
         image: An uploaded image file.
@@ -37,22 +569,116 @@ async def predict(image: UploadFile = File(...)):
         A JSON object containing the predicted class label.
     """
     
+    global pending_requests
+
     logging.info(f"Received request for image: {image.filename}")
-    
+
     contents = await image.read()
-    img = Image.open(io.BytesIO(contents))
-    img_t = preprocess(img)
-    batch_t = torch.unsqueeze(img_t, 0)
-    with torch.no_grad():
-        out = model(batch_t)
-        
-    _, index = torch.max(out, 1)
-    prediction = LABELS[index[0]]
+    cache_key = PredictionCache.key(contents)
+    prediction = prediction_cache.get(cache_key)
+    if prediction is not None:
+        logging.info(f"Cached prediction for {image.filename}: {prediction}")
+        return {"prediction": prediction}
+
+    if pending_requests >= MAX_PENDING_REQUESTS:
+        logging.warning(f"Rejecting {image.filename}: {pending_requests} requests already pending.")
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server overloaded, retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
+
+    pending_requests += 1
+    start_time = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        img = await loop.run_in_executor(executor, decode_image, contents)
+        index = await batcher.submit(img)
+    finally:
+        pending_requests -= 1
+    response.headers["X-Inference-Time"] = f"{time.perf_counter() - start_time:.6f}"
+    prediction = LABELS[index]
+    prediction_cache.put(cache_key, prediction)
     
     logging.info(f"Prediction for {image.filename}: {prediction}")
     
     return {"prediction": prediction}
 
+async def classify_item(loop, contents: bytes) -> str:
+    """Decodes and classifies one image of a batch through the micro-batcher."""
+    img = await loop.run_in_executor(executor, decode_image, contents)
+    return LABELS[await batcher.submit(img)]
+
+@app.post("/predict_batch")
+async def predict_batch(images: list[UploadFile] = File(...)):
+    """
+    Classifies several images uploaded in one request.
+
+    All images are queued on the micro-batcher together, so they are
+    classified in forward passes of up to MAX_BATCH_SIZE images. A batch is
+    admitted only if all its images fit under MAX_PENDING_REQUESTS.
+
+    Args:
+        images: The uploaded image files, as repeated `images` form fields.
+
+    Returns:
+        A JSON object with one entry per image, in upload order, holding
+        either its `prediction` or an `error`.
+    """
+    global pending_requests
+
+    logging.info(f"Received batch of {len(images)} images.")
+
+    contents = [await image.read() for image in images]
+    cache_keys = [PredictionCache.key(data) for data in contents]
+    predictions = [prediction_cache.get(key) for key in cache_keys]
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+
+    if pending_requests + len(missing) > MAX_PENDING_REQUESTS:
+        logging.warning(f"Rejecting batch of {len(missing)} images: {pending_requests} requests already pending.")
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server overloaded, retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
+
+    pending_requests += len(missing)
+    try:
+        loop = asyncio.get_running_loop()
+        outcomes = await asyncio.gather(
+            *(classify_item(loop, contents[i]) for i in missing), return_exceptions=True
+        )
+    finally:
+        pending_requests -= len(missing)
+
+    results = [{"filename": image.filename} for image in images]
+    for i, prediction in enumerate(predictions):
+        if prediction is not None:
+            results[i]["prediction"] = prediction
+    for i, outcome in zip(missing, outcomes):
+        if isinstance(outcome, BaseException):
+            results[i]["error"] = f"Could not classify image: {outcome}"
+        else:
+            results[i]["prediction"] = outcome
+            prediction_cache.put(cache_keys[i], outcome)
+    return {"predictions": results}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Returns the size and hit/miss counters of the prediction cache."""
+    return prediction_cache.stats()
+
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    if WORKERS > 1:
+        export_shared_weights(SHARED_WEIGHTS_PATH)
+        # The parent only supervises the workers, so it drops the model it
+        # loaded at import; the exported file is then the only copy in the pod.
+        batcher.model = None
+        del model
+        gc.collect()
+        # Spawned workers inherit the environment and pick up the shared weights.
+        os.environ["USE_SHARED_WEIGHTS"] = "1"
+        uvicorn.run("image_service:app", host="0.0.0.0", port=5000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=5000)
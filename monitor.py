@@ -1,110 +1,622 @@
-from prometheus_client import start_http_server, Gauge, Histogram
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+import asyncio
 import time
 import psutil
 import threading
-import socket
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Body, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from collections import deque
 import statistics
 import uvicorn
+import json
 import logging
-import numpy as np
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+try:
+    import msgpack
+except ImportError:  # msgpack bodies are optional
+    msgpack = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# The latency target the autoscaler keeps p99 under; the histogram buckets are
+# packed around it so Prometheus can tell how far above or below it we are.
+SLO_LATENCY_S = float(os.getenv("SLO_LATENCY_S", "0.33"))
+LATENCY_BUCKETS = sorted({0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.25, 0.3, SLO_LATENCY_S, 0.4, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0})
+CPU_SAMPLE_INTERVAL_S = float(os.getenv("CPU_SAMPLE_INTERVAL_S", "1"))
+
+# When STORE_PATH is set, completed per-second sketches are appended to that
+# file every PERSIST_INTERVAL_S, rolled up into 10 s and 1 min sketches, and
+# reloaded on startup. Each level is kept for its retention (seconds); older
+# records are dropped by a compaction every COMPACT_INTERVAL_S.
+STORE_PATH = os.getenv("STORE_PATH", "")
+PERSIST_INTERVAL_S = float(os.getenv("PERSIST_INTERVAL_S", "1"))
+COMPACT_INTERVAL_S = float(os.getenv("COMPACT_INTERVAL_S", "600"))
+LEVELS = (  # (interval, retention) in seconds
+    (1, int(os.getenv("RETENTION_1S_S", "3600"))),
+    (10, int(os.getenv("RETENTION_10S_S", "86400"))),
+    (60, int(os.getenv("RETENTION_1M_S", "2592000"))),
+)
+STEPS = {"1s": 0, "10s": 1, "1m": 2}
+
+# /stream pushes the stats of STREAM_WINDOW every STREAM_INTERVAL_S.
+STREAM_WINDOW = os.getenv("STREAM_WINDOW", "10s")
+STREAM_INTERVAL_S = float(os.getenv("STREAM_INTERVAL_S", "0.5"))
+
 cpu_usage = Gauge('cpu_usage_percent', 'CPU Usage in percent')
-request_latency = Histogram('request_latency_seconds', 'Request latency in seconds')
+request_latency = Histogram(
+    'request_latency_seconds', 'Request latency in seconds', ['phase', 'status'], buckets=LATENCY_BUCKETS
+)
+# Label values allowed on the histogram, to keep its cardinality bounded
+# whatever clients send; anything else is reported as "other".
+PHASES = ("total", "queue", "forward", "inference")
+
+# Quantiles are estimated with a DDSketch whose answers are within
+# SKETCH_RELATIVE_ACCURACY of the true value (1% by default).
+SKETCH_RELATIVE_ACCURACY = float(os.getenv("SKETCH_RELATIVE_ACCURACY", "0.01"))
+# Time windows /stats can report over; STATS_WINDOW is the default one.
+WINDOWS = {"10s": 10, "1m": 60, "5m": 300}
+STATS_WINDOW = os.getenv("STATS_WINDOW", "1m")
+# Labels a bulk upload may attach to its samples, as query parameters or
+# X-Label-<name> headers.
+LABEL_NAMES = ("pod", "route", "status", "phase", "priority", "tenant")
+MAX_BULK_SAMPLES = int(os.getenv("MAX_BULK_SAMPLES", "100000"))
+# At most MAX_SERIES distinct label sets get their own sketches; samples with
+# any further label set are folded into a single overflow series.
+MAX_SERIES = int(os.getenv("MAX_SERIES", "1000"))
+OVERFLOW_LABELS = (("overflow", "true"),)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=update_cpu_metrics, daemon=True).start()
+    if store is not None:
+        store.load(LATENCIES)
+        threading.Thread(target=store.run, args=(LATENCIES,), daemon=True).start()
+    yield
+    if store is not None:
+        store.persist(LATENCIES, final=True)
+
+app = FastAPI(title="Latency Monitor", lifespan=lifespan)
+
+class DDSketch:
+    """
+    Quantile sketch with relative-error guarantees (Masson et al., 2019).
+
+    Values are counted in logarithmically sized buckets, so inserts are O(1),
+    memory grows with the spread of values rather than their number, and two
+    sketches merge by adding their bucket counts.
+    """
+
+    def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        if value > 1e-9:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "DDSketch"):
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = max(math.ceil(q * self.count) - 1, 0)  # nearest-rank
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    # relative accuracy, zero count, count, sum, min, max, number of bins;
+    # followed by the bin keys (int32) and their counts (uint64).
+    HEADER = struct.Struct("<dQQdddI")
+
+    def to_bytes(self) -> bytes:
+        keys = sorted(self.bins)
+        header = self.HEADER.pack(
+            self.relative_accuracy, self.zero_count, self.count, self.sum, self.min, self.max, len(keys)
+        )
+        return header + struct.pack(f"<{len(keys)}i{len(keys)}Q", *keys, *(self.bins[key] for key in keys))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DDSketch":
+        accuracy, zero_count, count, total, low, high, n = cls.HEADER.unpack_from(data)
+        values = struct.unpack_from(f"<{n}i{n}Q", data, cls.HEADER.size)
+        sketch = cls(accuracy)
+        sketch.bins = dict(zip(values[:n], values[n:]))
+        sketch.zero_count, sketch.count, sketch.sum, sketch.min, sketch.max = zero_count, count, total, low, high
+        return sketch
+
+class SlidingWindowSketch:
+    """
+    Latencies from the last `horizon_s` seconds, kept as one DDSketch per second.
+
+    A window query merges the per-second sketches it covers, so every window
+    spans the same wall-clock time whatever the request rate.
+    """
+
+    def __init__(self, horizon_s: int = max(WINDOWS.values())):
+        self.horizon_s = horizon_s
+        self.slices = deque()  # (second, DDSketch), oldest first
+        self.lock = threading.Lock()
+
+    def _expire(self, now: int):
+        while self.slices and self.slices[0][0] <= now - self.horizon_s:
+            self.slices.popleft()
+
+    def add(self, value: float, now: float | None = None):
+        second = int(time.time() if now is None else now)
+        with self.lock:
+            if not self.slices or self.slices[-1][0] != second:
+                self._expire(second)
+                self.slices.append((second, DDSketch()))
+            self.slices[-1][1].add(value)
+
+    def add_many(self, values, now: float | None = None):
+        second = int(time.time() if now is None else now)
+        with self.lock:
+            if not self.slices or self.slices[-1][0] != second:
+                self._expire(second)
+                self.slices.append((second, DDSketch()))
+            sketch = self.slices[-1][1]
+            for value in values:
+                sketch.add(value)
+
+    def empty(self, now: float | None = None) -> bool:
+        with self.lock:
+            self._expire(int(time.time() if now is None else now))
+            return not self.slices
+
+    def window(self, seconds: int, now: float | None = None, merged: DDSketch | None = None) -> DDSketch:
+        now = int(time.time() if now is None else now)
+        merged = DDSketch() if merged is None else merged
+        with self.lock:
+            self._expire(now)
+            for second, sketch in reversed(self.slices):
+                if second <= now - seconds:
+                    break
+                merged.merge(sketch)
+        return merged
+
+class LabeledSeries:
+    """
+    One SlidingWindowSketch per distinct label set, e.g.
+    {"phase": "forward", "pod": "10.0.0.7", "status": "200"}.
+
+    Series that received nothing within the sketch horizon are dropped when
+    room is needed; beyond MAX_SERIES live series, new label sets share the
+    overflow series, which is reported as its own "overflow" group.
+    """
+
+    def __init__(self, max_series: int = MAX_SERIES):
+        self.max_series = max_series
+        self.series = {}
+        self.overflowed = 0
+        self.lock = threading.Lock()
+
+    def get(self, labels: dict) -> SlidingWindowSketch:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                if len(self.series) >= self.max_series:
+                    for stale in [k for k, v in self.series.items() if k != OVERFLOW_LABELS and v.empty()]:
+                        del self.series[stale]
+                if len(self.series) >= self.max_series:
+                    self.overflowed += 1
+                    key = OVERFLOW_LABELS
+                series = self.series.setdefault(key, SlidingWindowSketch())
+            return series
+
+    def group(self, seconds: int, group_by: list, filters: dict) -> dict:
+        """Merges the series matching `filters` into one sketch per value of the `group_by` labels."""
+        with self.lock:
+            items = list(self.series.items())
+        groups = {}
+        for key, series in items:
+            labels = dict(key)
+            if key == OVERFLOW_LABELS:
+                group = "overflow"
+            elif any(labels.get(name) != value for name, value in filters.items()):
+                continue
+            else:
+                group = "/".join(labels.get(name, "none") for name in group_by)
+            series.window(seconds, merged=groups.setdefault(group, DDSketch()))
+        return {group: sketch for group, sketch in groups.items() if sketch.count}
+
+class SketchStore:
+    """
+    Append-only file of per-interval DDSketches of LATENCIES.
+
+    Each record is (level, interval start, payload length) followed by the
+    serialized sketch; level 0 holds 1 s sketches, levels 1 and 2 their 10 s
+    and 1 min rollups, written once the interval is complete. Reads go
+    through mmap, a torn record at the end (from a crash mid-write) is cut
+    off on load, and `compact` rewrites the file without expired records.
+    """
+
+    RECORD = struct.Struct("<BqI")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_persisted = 0  # start of the newest 1 s record written
+        self.pending = {level: {} for level in range(1, len(LEVELS))}  # rollups in progress
+        self.last_compaction = time.time()
+        self.lock = threading.Lock()
+
+    def _scan(self):
+        """Yields (level, start, payload, end offset) for every complete record."""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + self.RECORD.size <= len(data):
+                level, start, length = self.RECORD.unpack_from(data, offset)
+                end = offset + self.RECORD.size + length
+                if end > len(data):
+                    break
+                yield level, start, data[offset + self.RECORD.size:end], end
+                offset = end
+
+    def _append(self, f, level: int, start: int, sketch: DDSketch):
+        payload = sketch.to_bytes()
+        f.write(self.RECORD.pack(level, start, len(payload)) + payload)
+
+    def _pend(self, level: int, start: int, sketch: DDSketch):
+        bucket = start - start % LEVELS[level][0]
+        self.pending[level].setdefault(bucket, DDSketch()).merge(sketch)
 
-# The maximum number of latency measurements to store in our rolling window.
-MAX_LATENCIES = 1000
+    def load(self, latencies: SlidingWindowSketch):
+        """Refills `latencies` from the stored 1 s sketches and resumes unfinished rollups."""
+        now = int(time.time())
+        with self.lock:
+            newest = [0] * len(LEVELS)
+            valid_end = 0
+            for level, start, _, end in self._scan():
+                newest[level] = max(newest[level], start)
+                valid_end = end
+            if os.path.exists(self.path) and os.path.getsize(self.path) > valid_end:
+                logging.warning(f"Truncating torn record at the end of {self.path}")
+                os.truncate(self.path, valid_end)
+            recent = []
+            for level, start, payload, _ in self._scan():
+                sketch = DDSketch.from_bytes(payload)
+                if sketch.relative_accuracy != SKETCH_RELATIVE_ACCURACY:
+                    continue  # sketches of different accuracies cannot be merged
+                if level + 1 < len(LEVELS) and start >= newest[level + 1] + LEVELS[level + 1][0]:
+                    self._pend(level + 1, start, sketch)
+                if level == 0 and start > now - latencies.horizon_s:
+                    recent.append((start, sketch))
+            self.last_persisted = newest[0]
+        with latencies.lock:
+            latencies.slices = deque(sorted(recent, key=lambda item: item[0]) + list(latencies.slices))
+        logging.info(f"Loaded {len(recent)} recent 1s sketches from {self.path}")
 
-app = FastAPI(title="Latency Monitor")
+    def persist(self, latencies: SlidingWindowSketch, final: bool = False):
+        """Appends the 1 s sketches completed since the last call, and any rollups they complete."""
+        # The current second may still be receiving samples, unless we are shutting down.
+        cutoff = int(time.time()) + (1 if final else -1)
+        with latencies.lock:
+            done = [(second, sketch) for second, sketch in latencies.slices if self.last_persisted < second < cutoff]
+        with self.lock, open(self.path, "ab") as f:
+            for second, sketch in done:
+                self._append(f, 0, second, sketch)
+                self._pend(1, second, sketch)
+                self.last_persisted = second
+            for level in range(1, len(LEVELS)):
+                interval = LEVELS[level][0]
+                for start in sorted(self.pending[level]):
+                    if start + interval <= cutoff:
+                        sketch = self.pending[level].pop(start)
+                        self._append(f, level, start, sketch)
+                        if level + 1 < len(LEVELS):
+                            self._pend(level + 1, start, sketch)
 
-# A deque (double-ended queue) is used to store the latency measurements.
-LATENCIES = deque(maxlen=MAX_LATENCIES)
+    def compact(self):
+        """Rewrites the file without records older than their level's retention."""
+        now = time.time()
+        with self.lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as out:
+                for level, start, payload, _ in self._scan():
+                    if start >= now - LEVELS[level][1]:
+                        out.write(self.RECORD.pack(level, start, len(payload)) + payload)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+            self.last_compaction = now
+
+    def history(self, start: int, end: int, level: int) -> list:
+        """Returns the (interval start, DDSketch) records of `level` in [start, end), oldest first."""
+        with self.lock:
+            records = [
+                (record_start, DDSketch.from_bytes(payload))
+                for record_level, record_start, payload, _ in self._scan()
+                if record_level == level and start <= record_start < end
+            ]
+        return sorted(records, key=lambda item: item[0])
+
+    def run(self, latencies: SlidingWindowSketch):
+        while True:
+            time.sleep(PERSIST_INTERVAL_S)
+            try:
+                self.persist(latencies)
+                if time.time() - self.last_compaction >= COMPACT_INTERVAL_S:
+                    self.compact()
+            except OSError as e:
+                logging.error(f"Could not persist latency sketches to {self.path}: {e}")
+
+# End-to-end latencies of successful requests, as polled by the autoscaler.
+LATENCIES = SlidingWindowSketch()
+SERIES = LabeledSeries()
+store = SketchStore(STORE_PATH) if STORE_PATH else None
+
+def check_latency(value) -> float:
+    """Returns `value` as a float, or raises ValueError unless it is a finite, non-negative number."""
+    latency = float(value)
+    if not math.isfinite(latency) or latency < 0:
+        raise ValueError(f"invalid latency {latency}")
+    return latency
+
+def ingest(latencies, labels: dict):
+    """
+    Adds a batch of latencies that share the same labels to their labelled
+    series, and to LATENCIES when they are successful end-to-end latencies
+    (phase "total", status 200 or unlabelled). The latencies must have been
+    validated with `check_latency`.
+    """
+    labels = {"phase": "total", **labels}
+    if labels["phase"] == "total" and labels.get("status", "200") == "200":
+        LATENCIES.add_many(latencies)
+    SERIES.get(labels).add_many(latencies)
+    histogram = request_latency.labels(*metric_labels(labels))
+    for latency in latencies:
+        histogram.observe(latency)
+
+def metric_labels(labels: dict) -> tuple:
+    """The (phase, status) histogram labels: a known phase, and an HTTP status code, "error" or ""."""
+    phase = labels["phase"] if labels["phase"] in PHASES else "other"
+    status = labels.get("status", "")
+    if status not in ("", "error") and not (len(status) == 3 and status.isascii() and status.isdigit()):
+        status = "other"
+    return phase, status
 
 @app.post("/record")
 async def record_latency(request: Request):
     """
-    Receives a latency measurement from the dispatcher and adds it to the queue.
+    Receives latency measurements from the dispatcher and adds them to the queue.
     
-    Expects a JSON payload like: {"latency": 0.123}
+    Expects a JSON payload like: {"latency": 0.123}, or a batch like
+    {"samples": [{"latency": 0.123}, ...]}.
     """
     data = await request.json()
-    latency = data.get("latency")
-    print(f"Received latency: {latency}")
-    if latency is not None:
-        LATENCIES.append(float(latency))
-        return {"status": "ok"}
-    return {"status": "error", "message": "Latency not provided"}, 400
+    try:
+        samples = data.get("samples")
+        if samples is not None:
+            return {"status": "ok", "recorded": ingest_samples(samples)}
+        latency = data.get("latency")
+        if latency is not None:
+            ingest([check_latency(latency)], request_labels(data))
+            return {"status": "ok"}
+    except (ValueError, TypeError) as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+    return JSONResponse(status_code=400, content={"status": "error", "message": "Latency not provided"})
+
+def request_labels(data: dict) -> dict:
+    return {name: str(data[name]) for name in LABEL_NAMES if data.get(name) is not None}
+
+def ingest_samples(samples: list) -> int:
+    """
+    Ingests [{"latency": ..., <labels>}, ...], grouping samples by their
+    labels. Nothing is ingested if any latency is invalid.
+    """
+    groups = {}
+    for sample in samples:
+        if sample.get("latency") is not None:
+            labels = request_labels(sample)
+            groups.setdefault(tuple(sorted(labels.items())), []).append(check_latency(sample["latency"]))
+    for labels, latencies in groups.items():
+        ingest(latencies, dict(labels))
+    return sum(len(latencies) for latencies in groups.values())
+
+def decode_float32(body: bytes) -> array:
+    if len(body) % 4:
+        raise ValueError("body is not a whole number of float32 values")
+    latencies = array("f")
+    latencies.frombytes(body)
+    if sys.byteorder == "big":
+        latencies.byteswap()  # the wire format is little-endian
+    return latencies
+
+@app.post("/record/bulk")
+async def record_bulk(request: Request):
+    """
+    Ingests many latencies in one call.
+
+    The body is either packed little-endian float32 values
+    (application/octet-stream) labelled by query parameters or X-Label-<name>
+    headers (e.g. ?pod=10.0.0.7&status=200), or an application/msgpack or
+    application/json document: a list of latencies, {"latencies": [...],
+    <labels>}, or {"samples": [{"latency": ..., <labels>}, ...]}.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    body = await request.body()
+    labels = {name: request.headers[f"x-label-{name}"] for name in LABEL_NAMES if f"x-label-{name}" in request.headers}
+    labels.update(request_labels(request.query_params))
+    try:
+        if content_type == "application/octet-stream":
+            data = decode_float32(body)
+        elif content_type in ("application/msgpack", "application/x-msgpack"):
+            if msgpack is None:
+                return JSONResponse(status_code=415, content={"status": "error", "message": "msgpack is not installed"})
+            data = msgpack.unpackb(body)
+        else:
+            data = json.loads(body)
+        if isinstance(data, dict) and "samples" in data:
+            samples = data["samples"][:MAX_BULK_SAMPLES]
+            for sample in samples:
+                for name, value in labels.items():
+                    sample.setdefault(name, value)
+            return {"status": "ok", "recorded": ingest_samples(samples)}
+        if isinstance(data, dict):
+            labels.update(request_labels(data))
+            data = data.get("latencies", [])
+        latencies = [check_latency(latency) for latency in data[:MAX_BULK_SAMPLES]]
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": f"Bad bulk payload: {e}"})
+    ingest(latencies, labels)
+    return {"status": "ok", "recorded": len(latencies)}
 
 @app.get("/stats")
-def get_stats():
+def get_stats(request: Request, window: str = STATS_WINDOW, group_by: str | None = None):
     """
-    Calculates and returns statistics over the current window of latencies.
+    Calculates and returns statistics over the latencies of the last `window`
+    (one of WINDOWS, e.g. ?window=10s).
+
+    With ?group_by=pod (or several labels, e.g. pod,status) the response also
+    has a "groups" breakdown of the labelled series, restricted by any label
+    given as a query parameter (e.g. &phase=inference). Unless grouped by,
+    phase defaults to "total", or to "forward" when grouping by pod, since
+    end-to-end samples are not tied to a pod.
     
     This is the endpoint polled by the custom autoscaler.
     """
-    if not LATENCIES:
-        # If we have no data, return a default empty response.
-        return {
-            "p99_latency": 0.0,
-            "p90_latency": 0.0,
-            "p50_latency": 0.0,
-            "average_latency": 0.0,
-            "measurement_count": 0
-        }
-        
-    # Use NumPy to efficiently calculate percentiles and average.
-    latencies_array = np.array(LATENCIES)
-    p99 = np.percentile(latencies_array, 99)
-    p90 = np.percentile(latencies_array, 90)
-    p50 = np.percentile(latencies_array, 50)
-    avg = np.mean(latencies_array)
-    
-    logging.info(f"Serving stats: p99={p99:.4f}s over {len(LATENCIES)} measurements.")
-    
+    if window not in WINDOWS:
+        return JSONResponse(status_code=400, content={"error": f"Unknown window {window!r}", "windows": list(WINDOWS)})
+    sketch = LATENCIES.window(WINDOWS[window])
+    stats = summarize(sketch)
+    stats["window"] = window
+    logging.info(f"Serving stats: p99={stats['p99_latency']:.4f}s over {sketch.count} measurements in {window}.")
+
+    if group_by:
+        group_by = [name.strip() for name in group_by.split(",")]
+        filters = request_labels(request.query_params)
+        if "phase" not in group_by:
+            filters.setdefault("phase", "forward" if "pod" in group_by else "total")
+        groups = SERIES.group(WINDOWS[window], group_by, filters)
+        stats["group_by"] = group_by
+        stats["groups"] = {group: summarize(sketch) for group, sketch in sorted(groups.items())}
+    return stats
+
+def summarize(sketch: DDSketch) -> dict:
     return {
-        "p99_latency": p99,
-        "p90_latency": p90,
-        "p50_latency": p50,
-        "average_latency": avg,
-        "measurement_count": len(LATENCIES)
+        "p99_latency": sketch.quantile(0.99),
+        "p90_latency": sketch.quantile(0.90),
+        "p50_latency": sketch.quantile(0.50),
+        "average_latency": sketch.mean(),
+        "measurement_count": sketch.count,
     }
 
+@app.get("/stream")
+async def stream_stats(request: Request, window: str = STREAM_WINDOW, interval: float = STREAM_INTERVAL_S,
+                       threshold: float = SLO_LATENCY_S):
+    """
+    Server-sent events with the /stats of `window`, pushed every `interval`
+    seconds (at least 0.1) as "stats" events.
+
+    When p99 crosses `threshold` a "breach" event is sent instead, and a
+    "recovered" event once it is back under it, so subscribers can react
+    without waiting for their next poll.
+    """
+    if window not in WINDOWS:
+        return JSONResponse(status_code=400, content={"error": f"Unknown window {window!r}", "windows": list(WINDOWS)})
+    interval = max(interval, 0.1)
+
+    async def events():
+        breached = False
+        while not await request.is_disconnected():
+            stats = summarize(LATENCIES.window(WINDOWS[window]))
+            stats["window"] = window
+            stats["breach"] = stats["p99_latency"] > threshold
+            event = "stats"
+            if stats["breach"] != breached:
+                event = "breach" if stats["breach"] else "recovered"
+                breached = stats["breach"]
+            yield f"event: {event}\ndata: {json.dumps(stats)}\n\n"
+            await asyncio.sleep(interval)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/history")
+def get_history(start: float | None = None, end: float | None = None, step: str | None = None):
+    """
+    Returns the persisted statistics of each interval between the unix
+    timestamps `start` and `end` (default: the last hour).
+
+    `step` is 1s, 10s or 1m; by default the finest one whose retention still
+    reaches back to `start` is used. Needs STORE_PATH.
+    """
+    if store is None:
+        return JSONResponse(status_code=404, content={"error": "History is disabled, set STORE_PATH"})
+    end = time.time() if end is None else end
+    start = end - 3600 if start is None else start
+    if step is None:
+        level = next((i for i, (_, retention) in enumerate(LEVELS) if start >= time.time() - retention), len(LEVELS) - 1)
+    elif step in STEPS:
+        level = STEPS[step]
+    else:
+        return JSONResponse(status_code=400, content={"error": f"Unknown step {step!r}", "steps": list(STEPS)})
+    records = store.history(int(start), int(end), level)
+    return {
+        "step": next(name for name, i in STEPS.items() if i == level),
+        "points": [{"time": record_start, **summarize(sketch)} for record_start, sketch in records],
+    }
+
+@app.get("/series")
+def get_series():
+    """Lists the labelled series currently kept, and how many label sets overflowed."""
+    with SERIES.lock:
+        keys = list(SERIES.series)
+    return {"series": [dict(key) for key in keys], "max_series": SERIES.max_series, "overflowed": SERIES.overflowed}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus exposition of the latency histogram and CPU gauge."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 def update_cpu_metrics():
+    """Samples CPU usage every CPU_SAMPLE_INTERVAL_S; runs in a daemon thread."""
     while True:
         try:
-            cpu_usage.set(psutil.cpu_percent())
-            time.sleep(1)
+            # Blocks for the interval and reports the average over it.
+            cpu_usage.set(psutil.cpu_percent(interval=CPU_SAMPLE_INTERVAL_S))
         except Exception as e:
             print(f"Error updating CPU metrics: {e}")
-
-def is_port_in_use(port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('localhost', port)) == 0
-
-def start_monitoring(port=8000):
-    # Check if port is available
-    if is_port_in_use(port):
-        print(f"Warning: Port {port} is already in use!")
-        return
-
-    # Start CPU monitoring in background
-    threading.Thread(target=update_cpu_metrics, daemon=True).start()
-    
-    try:
-        # Start Prometheus metrics server
-        start_http_server(port, addr='0.0.0.0')  # Bind to all interfaces
-        print(f"Monitoring server started on port {port}")
-        print(f"Try accessing metrics at: http://localhost:{port}/metrics")
-        
-        # Keep the main thread alive
-        while True:
-            time.sleep(1)
-    except Exception as e:
-        print(f"Error starting monitoring server: {e}")
+            time.sleep(CPU_SAMPLE_INTERVAL_S)
 
 if __name__ == '__main__':
     # Run tiny server; in Kubernetes expose via ClusterIP